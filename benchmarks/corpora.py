@@ -0,0 +1,71 @@
+import random
+
+## seeded synthetic inputs for the benchmarks. everything stays inside the codec
+## alphabet: printable ASCII 37-126, with the '$' (36) terminator added at the end,
+## so '_' stands in for spaces and '~' for line breaks
+
+ALPHABET = ''.join(chr(code) for code in range(37, 127))
+
+WORDS = (
+    "the of and to in is was that for on with as by at from his her it be are "
+    "this which or had not but have an they were their one all has been would "
+    "there more when will who she can said each time only into other about some "
+    "compression block transform suffix array stream symbol length frequency "
+    "number between through during before after because however system data"
+).split()
+
+LOG_LEVELS = ("INFO", "INFO", "INFO", "DEBUG", "WARN", "ERROR")
+LOG_MESSAGES = (
+    "request_handled", "cache_miss", "cache_hit", "connection_opened",
+    "connection_closed", "retrying_upstream", "timeout_waiting_for_lock",
+)
+
+
+def random_text(size, rng):
+    return ''.join(rng.choice(ALPHABET) for _ in range(size))
+
+
+def dna_text(size, rng):
+    return ''.join(rng.choice("ACGT") for _ in range(size))
+
+
+def natural_text(size, rng):
+    # words drawn with a zipf-like skew so common words dominate like in prose
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    pieces = []
+    length = 0
+    while length < size:
+        word = rng.choices(WORDS, weights)[0]
+        if rng.random() < 0.08:
+            word = word.capitalize() + rng.choice(".,;")
+        pieces.append(word)
+        length += len(word) + 1
+    return '_'.join(pieces)[:size]
+
+
+def log_text(size, rng):
+    # highly repetitive lines that only differ in timestamp, level, id and message
+    pieces = []
+    length = 0
+    timestamp = 1_700_000_000
+    while length < size:
+        timestamp += rng.randint(0, 3)
+        line = (f"{timestamp}|{rng.choice(LOG_LEVELS)}|worker-{rng.randint(1, 8)}|"
+                f"{rng.choice(LOG_MESSAGES)}|id={rng.randint(1000, 1099)}~")
+        pieces.append(line)
+        length += len(line)
+    return ''.join(pieces)[:size]
+
+
+CORPORA = {
+    "random": random_text,
+    "logs": log_text,
+    "dna": dna_text,
+    "natural": natural_text,
+}
+
+
+def generate(kind, size, seed=0):
+    ## `size` characters of the given corpus followed by the '$' terminator
+    rng = random.Random(f"{kind}:{size}:{seed}")
+    return CORPORA[kind](size, rng) + '$'
@@ -0,0 +1,266 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import corpora
+from q1 import DEFAULT_ENGINE
+from q2_encoder import encoder
+from q2_decoder import decode
+from q2_stats import PipelineStats
+
+## end to end benchmark of the codec on seeded synthetic corpora
+##
+##   python benchmarks/run_benchmarks.py --sizes 1KB,64KB,1MB --output results.json
+##   python benchmarks/run_benchmarks.py --baseline results.json --threshold 0.15
+##
+## every case runs in a fresh process so peak RSS belongs to that case alone, and
+## is timed --repeat times in it; the fastest run of the case and of every stage is
+## what gets recorded and compared, the others are noise from the machine. the exit
+## status is 1 when a round trip fails or a case regresses past the threshold, and a
+## slowdown only counts when the fastest new run is also slower than every baseline
+## run. a time that is under --min-seconds in both runs is not compared at all, a
+## few milliseconds swing by more than any threshold. the cases also run under a fixed
+## string hash seed (--hash-seed), the decode table lookups alone are ~30% apart
+## between two seeds, and every run of the harness would otherwise get a new one
+
+DEFAULT_SIZES = "1KB,16KB,256KB"
+SIZE_UNITS = {"KB": 1024, "MB": 1024 * 1024, "B": 1}
+DEFAULT_REPEAT = 5
+DEFAULT_MIN_SECONDS = 0.1
+DEFAULT_HASH_SEED = 0
+
+# higher is better for throughput (with the time it is computed from), lower is
+# better for the compression ratio
+HIGHER_IS_BETTER = {"encode_mb_s": "encode_seconds", "decode_mb_s": "decode_seconds"}
+LOWER_IS_BETTER = ("ratio",)
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit, scale in SIZE_UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * scale)
+    return int(text)
+
+
+def throughput(size, seconds):
+    return size / (1024 * 1024) / seconds if seconds > 0 else 0.0
+
+
+def fastest_stages(runs, side, size):
+    ## every stage as it was in the run where it was fastest, with its MB/s and the
+    ## seconds of every run
+    table = {}
+    for run in runs:
+        for name, totals in run[side].items():
+            if name not in table or totals["seconds"] < table[name]["seconds"]:
+                table[name] = dict(totals)
+    for name, totals in table.items():
+        totals["mb_s"] = throughput(size, totals["seconds"])
+        totals["seconds_all"] = [run[side][name]["seconds"] for run in runs if name in run[side]]
+    return table
+
+
+def run_once(s, engine, block_size, workers, trace_memory):
+    encode_stats = PipelineStats()
+    decode_stats = PipelineStats()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        compressed = os.path.join(tmp, "case.bin")
+        restored = os.path.join(tmp, "case.txt")
+
+        # garbage from the run before is not collected on this run's clock
+        gc.collect()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        encoder(s, engine, block_size, workers, output_filename=compressed, stats=encode_stats)
+        encode_seconds = time.perf_counter() - start
+        if trace_memory:
+            _, encode_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+
+        gc.collect()
+        start = time.perf_counter()
+        decode(compressed, restored, workers=workers or 1, stats=decode_stats)
+        decode_seconds = time.perf_counter() - start
+        if trace_memory:
+            _, decode_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        compressed_bytes = os.path.getsize(compressed)
+        with open(restored, 'r') as file:
+            roundtrip_ok = file.read() == s
+
+    return {
+        "encode_seconds": encode_seconds,
+        "decode_seconds": decode_seconds,
+        "encode": encode_stats.as_dict(),
+        "decode": decode_stats.as_dict(),
+        "compressed_bytes": compressed_bytes,
+        "roundtrip_ok": roundtrip_ok,
+        "peaks": {"encode": encode_peak, "decode": decode_peak} if trace_memory else None,
+    }
+
+
+def run_case(kind, size, seed, engine, block_size, workers, trace_memory, repeat=DEFAULT_REPEAT):
+    s = corpora.generate(kind, size, seed)
+    # tracemalloc slows everything down, only the first run pays for it
+    runs = [run_once(s, engine, block_size, workers, trace_memory and i == 0) for i in range(repeat)]
+    encode_seconds = min(run["encode_seconds"] for run in runs)
+    decode_seconds = min(run["decode_seconds"] for run in runs)
+    compressed_bytes = runs[0]["compressed_bytes"]
+
+    result = {
+        "corpus": kind,
+        "size": size,
+        "repeat": repeat,
+        "encode_seconds": encode_seconds,
+        "decode_seconds": decode_seconds,
+        "encode_seconds_all": [run["encode_seconds"] for run in runs],
+        "decode_seconds_all": [run["decode_seconds"] for run in runs],
+        "encode_mb_s": throughput(len(s), encode_seconds),
+        "decode_mb_s": throughput(len(s), decode_seconds),
+        "compressed_bytes": compressed_bytes,
+        "ratio": compressed_bytes / len(s),
+        "roundtrip_ok": all(run["roundtrip_ok"] for run in runs),
+        # ru_maxrss is KiB on linux, bytes on macOS
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                          * (1 if sys.platform == "darwin" else 1024),
+        "stages": {
+            "encode": fastest_stages(runs, "encode", len(s)),
+            "decode": fastest_stages(runs, "decode", len(s)),
+        },
+    }
+    if trace_memory:
+        result["peak_tracemalloc_bytes"] = runs[0]["peaks"]
+    return result
+
+
+def run_isolated(*args):
+    # a fresh interpreter per case, so ru_maxrss is not inherited from earlier cases.
+    # spawned, not forked, so it takes PYTHONHASHSEED from the environment main sets
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_case, *args).result()
+
+
+def case_key(case):
+    return f"{case['corpus']}:{case['size']}"
+
+
+def slower(seconds, seconds_all, old_seconds, old_seconds_all, threshold, min_seconds):
+    ## a slowdown past the threshold that the noise between runs does not explain:
+    ## the fastest new run misses the threshold against the fastest baseline run and
+    ## is slower than every baseline run too. older baselines have no per-run times
+    if max(seconds, old_seconds) < min_seconds:
+        return False
+    return (seconds * (1 - threshold) > old_seconds
+            and seconds > max(old_seconds_all or [old_seconds]))
+
+
+def compare(results, baseline, threshold, min_seconds=DEFAULT_MIN_SECONDS):
+    ## list of human readable regressions against a saved baseline run
+    regressions = []
+    previous = {case_key(case): case for case in baseline["cases"]}
+    for case in results["cases"]:
+        key = case_key(case)
+        if not case["roundtrip_ok"]:
+            regressions.append(f"{key}: round trip failed")
+        old = previous.get(key)
+        if old is None:
+            continue
+        for metric, seconds in HIGHER_IS_BETTER.items():
+            if slower(case[seconds], case.get(seconds + "_all"), old[seconds], old.get(seconds + "_all"),
+                      threshold, min_seconds):
+                regressions.append(f"{key}: {metric} {old[metric]:.3f} -> {case[metric]:.3f}")
+        for metric in LOWER_IS_BETTER:
+            if case[metric] > old[metric] * (1 + threshold):
+                regressions.append(f"{key}: {metric} {old[metric]:.4f} -> {case[metric]:.4f}")
+        for side in ("encode", "decode"):
+            for name, totals in case["stages"][side].items():
+                old_totals = old["stages"][side].get(name)
+                if old_totals is None:
+                    continue
+                if slower(totals["seconds"], totals.get("seconds_all"), old_totals["seconds"],
+                          old_totals.get("seconds_all"), threshold, min_seconds):
+                    regressions.append(f"{key}: {side} stage {name} "
+                                       f"{old_totals['mb_s']:.3f} -> {totals['mb_s']:.3f} MB/s")
+    return regressions
+
+
+def print_summary(results):
+    print(f"{'corpus':>8} {'size':>10} {'ratio':>7} {'enc MB/s':>9} {'dec MB/s':>9} {'rss MB':>8} {'ok':>3}")
+    for case in results["cases"]:
+        print(f"{case['corpus']:>8} {case['size']:>10} {case['ratio']:>7.3f} "
+              f"{case['encode_mb_s']:>9.3f} {case['decode_mb_s']:>9.3f} "
+              f"{case['peak_rss_bytes'] / 2 ** 20:>8.1f} {'yes' if case['roundtrip_ok'] else 'NO':>3}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the BWT/Huffman codec")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated, e.g. 1KB,1MB,64MB")
+    parser.add_argument("--corpora", default=",".join(corpora.CORPORA), help="comma separated corpus names")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", default=DEFAULT_ENGINE)
+    parser.add_argument("--block-size", type=parse_size, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tracemalloc", action="store_true", help="also record python heap peaks (slow)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative slowdown")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="runs per case, the fastest one counts")
+    parser.add_argument("--min-seconds", type=float, default=DEFAULT_MIN_SECONDS,
+                        help="times shorter than this in both runs are not compared")
+    parser.add_argument("--hash-seed", type=int, default=DEFAULT_HASH_SEED,
+                        help="PYTHONHASHSEED of the case processes, keep it when comparing")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat has to be at least 1")
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "engine": args.engine,
+            "block_size": args.block_size,
+            "workers": args.workers,
+            "repeat": args.repeat,
+            "hash_seed": args.hash_seed,
+        },
+        "cases": [],
+    }
+    os.environ["PYTHONHASHSEED"] = str(args.hash_seed)
+    for size in [parse_size(size) for size in args.sizes.split(",")]:
+        for kind in args.corpora.split(","):
+            results["cases"].append(run_isolated(kind, size, args.seed, args.engine, args.block_size,
+                                                 args.workers, args.tracemalloc, args.repeat))
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print_summary(results)
+
+    failures = [f"{case_key(case)}: round trip failed" for case in results["cases"] if not case["roundtrip_ok"]]
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            failures = compare(results, json.load(file), args.threshold, args.min_seconds)
+    for failure in failures:
+        print("REGRESSION", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import corpora
+from q2_service import CompressionService, ServiceClient, DEFAULT_QUEUE_SIZE
+
+## load generator for q2_service.py, every request is a compress followed by a
+## decompress of the result, checked against the input
+##
+##   python benchmarks/service_load.py --local --requests 2000 --concurrency 64
+##   python benchmarks/service_load.py --socket /tmp/q2.sock --size 4KB
+##
+## --local starts the service inside this process (its workers are still separate
+## processes), so nothing else has to be running
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_client(client, payloads, latencies, counter):
+    failures = 0
+    while True:
+        index = counter[0]
+        if index >= len(payloads):
+            return failures
+        counter[0] += 1
+        payload = payloads[index]
+        start = time.perf_counter()
+        compressed = await client.compress(payload)
+        restored = await client.decompress(compressed)
+        latencies.append(time.perf_counter() - start)
+        if restored != payload:
+            failures += 1
+
+
+async def generate_load(args, path, host, port):
+    payloads = [corpora.generate(args.corpus, args.size, args.seed + i)[:-1].encode('latin-1')
+                for i in range(min(args.requests, args.distinct))]
+    payloads = [payloads[i % len(payloads)] for i in range(args.requests)]
+
+    clients = [await ServiceClient.connect(path, host, port) for _ in range(args.connections)]
+    latencies = []
+    counter = [0]
+    start = time.perf_counter()
+    failures = await asyncio.gather(*[run_client(clients[i % len(clients)], payloads, latencies, counter)
+                                      for i in range(args.concurrency)])
+    seconds = time.perf_counter() - start
+    for client in clients:
+        await client.close()
+
+    return {
+        "requests": args.requests,
+        "size": args.size,
+        "concurrency": args.concurrency,
+        "seconds": seconds,
+        "requests_s": args.requests / seconds,
+        "mb_s": args.requests * args.size / (1024 * 1024) / seconds,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "failures": sum(failures),
+    }
+
+
+async def run(args):
+    if not args.local:
+        return await generate_load(args, args.socket, args.host, args.port)
+    service = CompressionService(args.workers, args.queue_size)
+    await service.start(port=0)
+    host, port = service.address()[:2]
+    try:
+        result = await generate_load(args, None, host, port)
+    finally:
+        await service.close()
+    result["batches"] = service.batches
+    result["requests_per_batch"] = service.requests / service.batches if service.batches else 0.0
+    return result
+
+
+def main(argv=None):
+    from run_benchmarks import parse_size
+
+    parser = argparse.ArgumentParser(description="load generator for the compression service")
+    parser.add_argument("--socket", help="unix socket path of a running service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7878)
+    parser.add_argument("--local", action="store_true", help="start the service in this process")
+    parser.add_argument("--workers", type=int, default=None, help="with --local")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="with --local")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--size", type=parse_size, default=1024, help="bytes per request")
+    parser.add_argument("--corpus", default="logs", choices=sorted(corpora.CORPORA))
+    parser.add_argument("--distinct", type=int, default=64, help="different payloads to cycle through")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    return 1 if result["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from q1 import build_suffix_tree
+
+
+class LegacyNode:
+    # the node layout before the compact tree: a __dict__ per node and a full
+    # [36, 126] children list, kept here only to measure what we used to pay
+    def __init__(self, start=None, end=None, suffix_index=None):
+        self.children = [None] * (126 - 36 + 1)
+        self.start = start
+        self.end = end
+        self.suffix_index = suffix_index
+        self.suffix_link = None
+
+
+def random_text(n, alphabet, seed):
+    rng = random.Random(seed)
+    return ''.join(rng.choice(alphabet) for _ in range(n)) + '$'
+
+
+def count_nodes(root):
+    # iterative walk, the trees here are deep enough to hit the recursion limit
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children.values())
+    return count
+
+
+def measure_compact(s):
+    tracemalloc.start()
+    root = build_suffix_tree(s)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return root, current
+
+
+def measure_legacy(node_count):
+    # allocate the same number of nodes with the old layout
+    tracemalloc.start()
+    nodes = [LegacyNode(0, 0, 0) for _ in range(node_count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del nodes
+    return current
+
+
+def main(sizes):
+    print(f"{'n':>8} {'alphabet':>10} {'nodes':>8} {'before B/char':>14} {'after B/char':>13} {'ratio':>6}")
+    for n in sizes:
+        for alphabet in ("acgt", "abcdefghijklmnopqrstuvwxyz"):
+            s = random_text(n, alphabet, seed=n)
+            root, after = measure_compact(s)
+            nodes = count_nodes(root)
+            before = measure_legacy(nodes)
+            print(f"{len(s):>8} {len(alphabet):>10} {nodes:>8} "
+                  f"{before / len(s):>14.1f} {after / len(s):>13.1f} {before / after:>6.1f}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
@@ -0,0 +1,252 @@
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import os
+import sys
+
+## one entry point for batch jobs, many files per process instead of one python
+## (and one numpy/bitarray import) per file
+##
+##   python cli.py compress logs/*.txt --output-dir out --workers 4
+##   python cli.py decompress out/*.q2
+##   python cli.py rank text.txt queries1.txt queries2.txt
+##   python cli.py bench --from-list files.txt --timing
+##
+## only the standard library is imported up front, the codec and suffix array
+## modules are imported by the subcommand that needs them (and once per worker
+## process, not once per file). --timing prints how long startup, the imports and
+## each file took, and how much of the run went to anything other than the files
+
+COMPRESSED_SUFFIX = ".q2"
+DECOMPRESSED_SUFFIX = ".out"
+RANKS_SUFFIX = ".ranks"
+
+
+def output_path(path, output_dir, suffix, strip=None):
+    ## next to the input unless output_dir is given. strip is a suffix taken off
+    ## the name instead of adding one (decompressing x.txt.q2 gives x.txt)
+    name = os.path.basename(path)
+    if strip is not None and name.endswith(strip) and len(name) > len(strip):
+        name = name[:-len(strip)]
+    else:
+        name += suffix
+    return os.path.join(output_dir or os.path.dirname(path), name)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def check_output(path, options):
+    ## like gzip, an existing output is only replaced with --force
+    if not options["force"] and os.path.exists(path):
+        raise FileExistsError(f"{path} already exists, use --force to overwrite it")
+    return path
+
+
+def write_bytes(path, data, options):
+    # 'xb' so a file that appeared since check_output is not clobbered either
+    with open(path, 'wb' if options["force"] else 'xb') as file:
+        file.write(data)
+
+
+def compress_file(path, options):
+    from q2_codec import compress
+
+    target = check_output(output_path(path, options["output_dir"], COMPRESSED_SUFFIX), options)
+    data = read_bytes(path)
+    result = compress(data, options["block_size"], options["engine"])
+    write_bytes(target, result, options)
+    return len(data), len(result)
+
+
+def decompress_file(path, options):
+    from q2_codec import decompress
+
+    target = check_output(output_path(path, options["output_dir"], DECOMPRESSED_SUFFIX,
+                                      strip=COMPRESSED_SUFFIX), options)
+    data = read_bytes(path)
+    result = decompress(data)
+    write_bytes(target, result, options)
+    return len(data), len(result)
+
+
+def rank_file(path, options):
+    ## path is a positions file, answered from the index main builds once
+    from q1 import answer_rank_queries
+
+    target = check_output(output_path(path, options["output_dir"], RANKS_SUFFIX), options)
+    count = answer_rank_queries(options["index"], path, target)
+    return os.path.getsize(path), count
+
+
+def bench_file(path, options):
+    ## a round trip in memory, nothing is written
+    from q2_codec import compress, decompress
+
+    data = read_bytes(path)
+    start = time.perf_counter()
+    result = compress(data, options["block_size"], options["engine"])
+    middle = time.perf_counter()
+    ok = decompress(result) == data
+    end = time.perf_counter()
+    return len(data), len(result), middle - start, end - middle, ok
+
+
+COMMANDS = {
+    "compress": compress_file,
+    "decompress": decompress_file,
+    "rank": rank_file,
+    "bench": bench_file,
+}
+
+# what each subcommand imports, timed once in the parent and once per worker
+IMPORTS = {
+    "compress": ("q2_codec",),
+    "decompress": ("q2_codec",),
+    "rank": ("q1",),
+    "bench": ("q2_codec",),
+}
+
+
+def warm_imports(command):
+    start = time.perf_counter()
+    for module in IMPORTS[command]:
+        __import__(module)
+    return time.perf_counter() - start
+
+
+def run_file(command, path, options):
+    ## (path, seconds, result or None, error message or None), never raises so one
+    ## bad file does not stop the batch
+    start = time.perf_counter()
+    try:
+        result = COMMANDS[command](path, options)
+        error = None
+    except Exception as failure:
+        result = None
+        error = f"{type(failure).__name__}: {failure}"
+    return path, time.perf_counter() - start, result, error
+
+
+def run_files(command, paths, options, workers):
+    if workers == 1 or len(paths) == 1:
+        return [run_file(command, path, options) for path in paths]
+    from concurrent.futures import ProcessPoolExecutor
+
+    # every worker pays the imports once, at its first file
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_file, [command] * len(paths), paths, [options] * len(paths),
+                             chunksize=max(1, len(paths) // (workers * 4))))
+
+
+def read_file_list(filename):
+    file = sys.stdin if filename == "-" else open(filename, 'r')
+    try:
+        return [line.strip() for line in file if line.strip()]
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def build_index(text_path, options):
+    ## the rank index of the text, reused as it is when text_path already is one or
+    ## when the index from an earlier run is newer than the text. only a stale index
+    ## is rebuilt, and like any other output that needs --force
+    from q1 import INDEX_MAGIC, build_rank_index
+
+    with open(text_path, 'rb') as file:
+        if file.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            return text_path
+    index = output_path(text_path, options["output_dir"], ".saix")
+    if os.path.exists(index):
+        if os.stat(index).st_mtime_ns >= os.stat(text_path).st_mtime_ns:
+            return index
+        if not options["force"]:
+            raise FileExistsError(f"{index} is older than {text_path}, use --force to rebuild it")
+    build_rank_index(text_path, index, options["engine"])
+    return index
+
+
+def print_results(command, results):
+    for path, seconds, result, error in results:
+        if error is not None:
+            print(f"{path}: {error}", file=sys.stderr)
+        elif command == "bench":
+            size, compressed, encode_seconds, decode_seconds, ok = result
+            print(f"{path}: {size} -> {compressed} bytes ({compressed / max(size, 1):.3f}), "
+                  f"encode {encode_seconds:.3f}s decode {decode_seconds:.3f}s"
+                  f"{'' if ok else ' ROUND TRIP FAILED'}")
+        elif command == "rank":
+            print(f"{path}: {result[1]} ranks in {seconds:.3f}s")
+        else:
+            print(f"{path}: {result[0]} -> {result[1]} bytes in {seconds:.3f}s")
+
+
+def print_timing(startup, imports, wall, results, workers):
+    busy = sum(seconds for _, seconds, _, _ in results)
+    files = max(len(results), 1)
+    # with a pool the files overlap, overhead is what the workers could not hide
+    overhead = max(wall - busy / workers, 0.0)
+    print(f"startup {startup * 1000:.1f} ms, imports {imports * 1000:.1f} ms, "
+          f"{len(results)} files in {wall:.3f}s on {workers} workers, "
+          f"{busy / files * 1000:.1f} ms per file, overhead {overhead / files * 1000:.1f} ms per file",
+          file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="batch BWT/Huffman compression")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("compress", "compress files to <name>.q2"),
+                            ("decompress", "decompress .q2 files"),
+                            ("rank", "suffix ranks of positions files against one text"),
+                            ("bench", "time a round trip of every file, nothing is written")):
+        command = commands.add_parser(name, help=help_text)
+        if name == "rank":
+            command.add_argument("text", help="the text, or a rank index saved by q1.py index")
+        command.add_argument("paths", nargs="*")
+        command.add_argument("--from-list", help="file with one input path per line, - for stdin")
+        command.add_argument("--output-dir", help="write outputs here instead of next to the inputs")
+        command.add_argument("--workers", type=int, default=None, help="default: one per CPU")
+        command.add_argument("--engine", default="sais")
+        command.add_argument("--block-size", type=int, default=500_000)
+        command.add_argument("--timing", action="store_true", help="report startup and per-file overhead")
+        if name != "bench":
+            command.add_argument("-f", "--force", action="store_true", help="overwrite existing outputs")
+    args = parser.parse_args(argv)
+
+    paths = list(args.paths)
+    if args.from_list:
+        paths += read_file_list(args.from_list)
+    if not paths:
+        parser.error("no input files")
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    workers = max(1, min(args.workers or os.cpu_count() or 1, len(paths)))
+    startup = time.perf_counter() - STARTED
+
+    imports = warm_imports(args.command)
+    start = time.perf_counter()
+    options = {"output_dir": args.output_dir, "engine": args.engine, "block_size": args.block_size,
+               "force": getattr(args, "force", False)}
+    if args.command == "rank":
+        try:
+            options["index"] = build_index(args.text, options)
+        except FileExistsError as failure:
+            parser.exit(1, f"{failure}\n")
+    results = run_files(args.command, paths, options, workers)
+    wall = time.perf_counter() - start
+
+    print_results(args.command, results)
+    if args.timing:
+        print_timing(startup, imports, wall, results, workers)
+    failed = any(error is not None or (args.command == "bench" and not result[4])
+                 for _, _, result, error in results)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,36 @@
+import mmap
+import struct
 import sys
+from array import array
 
 class Node:
+    # slots instead of a per-instance __dict__, the tree has ~2n nodes so this adds up
+    __slots__ = ("children", "start", "end", "suffix_index", "suffix_link")
+
     def __init__(self, start=None, end=None, suffix_index=None):
-        # Initialize a list with slots for each character in the ASCII range [36, 126]
-        self.children = [None] * (126 - 36 + 1) ## for alphabetical order
+        # sparse children keyed by the first character of the edge, most nodes only
+        # have a couple of children so a full [36, 126] slot list was mostly None
+        self.children = {}
         self.start = start  # Start index of the edge label leading to this node
         self.end = end  # End index of the edge label leading to this node
         self.suffix_index = suffix_index  # Only set for leaf nodes
         self.suffix_link = None  # Suffix link to another node
 
     def is_leaf(self):
-        return all(child is None for child in self.children)
+        # an empty dict is falsy, O(1) instead of scanning every slot
+        return not self.children
 
     def add_child(self, char, node):
-        self.children[ord(char) - 36] = node
+        self.children[char] = node
 
     def get_child(self, char):
-        return self.children[ord(char) - 36]
+        return self.children.get(char)
 
     def iter_children(self):
-        for index, child in enumerate(self.children):
-            if child is not None:
-                yield chr(index + 36), child
+        ## for alphabetical order, the dict only remembers insertion order so sort the keys
+        children = self.children
+        for char in sorted(children):
+            yield char, children[char]
 
 def extend_suffix_tree(root, s, phase_index, suffix_start,activeNode, last_internal_node=None):
 
@@ -96,7 +105,7 @@ def extend_suffix_tree(root, s, phase_index, suffix_start,activeNode, last_inter
 
                     #reset the current endbound to the missmatch position
                     current.end = split_point - 1
-                    current.children = [None] * (126 - 36 + 1)
+                    current.children = {}
                     # add 2 newly created children
                     current.add_child(s[split_point], existing_continuation)
                     current.add_child(s[index], new_suffix_node)
@@ -202,25 +211,288 @@ def build_suffix_tree(s):
 #     is_leaf = "Leaf" if node.is_leaf() else "Internal"
 #     print(f"{indent}{label} [{is_leaf}, Suffix Link -> {link_label}]")
 
-#     for char_index, child in enumerate(node.children):
+#     for _, child in node.iter_children():
 #         if child:
 #             print_suffix_tree(child, s, depth + 1)
 
 
+def iter_suffix_array(node):
+    ## a DFS through the tree with an explicit stack, so long runs like "aaaa...$"
+    ## (a path as deep as the input) don't hit the recursion limit
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        ## if we reach a leaf, yield it suffix index, since the tree was make
+        ## in alphabetical order, so the indices come out sorted
+        if node.is_leaf():
+            yield node.suffix_index
+        else:
+            # push in reverse so the smallest child is popped first
+            stack.extend(child for _, child in reversed(list(node.iter_children())))
+
+
 def collect_suffix_array(node, s, suffix_array=None):
-    ## a DFS through the tree
     if suffix_array is None:
         suffix_array = []
-    ## if we reach a leaf, append it suffix index, since the tree was make
-    ## in alphabetical order, so we can just append the index indicating the suffix, and it will be sorted
-    if node.is_leaf():
-        suffix_array.append(node.suffix_index)
-    # recursive call
-    for _, child in node.iter_children():
-        collect_suffix_array(child, s, suffix_array)
+    suffix_array.extend(iter_suffix_array(node))
     return suffix_array
 
 
+def collect_suffix_array_into(node, buffer=None):
+    ## write the suffix array straight into a typed buffer, 4 bytes per entry instead
+    ## of a list of python ints. buffer can be a preallocated array('i') / numpy int32
+    ## array of the input length, otherwise a new array('i') is grown
+    if buffer is None:
+        buffer = array('i')
+        buffer.extend(iter_suffix_array(node))
+        return buffer
+    for rank, suffix_index in enumerate(iter_suffix_array(node)):
+        buffer[rank] = suffix_index
+    return buffer
+
+
+def suffix_array_from_tree(s):
+    ## the original engine, kept as a reference: build the ukkonen tree and DFS it
+    root = build_suffix_tree(s)
+    return collect_suffix_array_into(root)
+
+
+def sais(s, upper):
+    ## SA-IS (Nong, Zhang & Chan), linear time suffix sorting
+    ## s is a list of ints in [0, upper], no sentinel needed, a shorter suffix
+    ## sorts before a longer one that it is a prefix of (same as the tree order)
+    n = len(s)
+    if n == 0:
+        return []
+    if n == 1:
+        return [0]
+    if n == 2:
+        return [0, 1] if s[0] < s[1] else [1, 0]
+
+    sa = [0] * n
+    # ls[i] is True when suffix i is S-type (smaller than suffix i + 1)
+    ls = [False] * n
+    for i in range(n - 2, -1, -1):
+        ls[i] = ls[i + 1] if s[i] == s[i + 1] else s[i] < s[i + 1]
+
+    # bucket boundaries, sum_l is the start of each bucket, sum_s the start of its S part
+    sum_l = [0] * (upper + 1)
+    sum_s = [0] * (upper + 1)
+    for i in range(n):
+        if not ls[i]:
+            sum_s[s[i]] += 1
+        else:
+            sum_l[s[i] + 1] += 1
+    for i in range(upper + 1):
+        sum_s[i] += sum_l[i]
+        if i < upper:
+            sum_l[i + 1] += sum_s[i]
+
+    def induce(lms):
+        sa[:] = [-1] * n
+        # place the LMS suffixes at the start of the S part of their bucket
+        buf = sum_s[:]
+        for d in lms:
+            if d == n:
+                continue
+            sa[buf[s[d]]] = d
+            buf[s[d]] += 1
+        # induce L-type suffixes left to right
+        buf = sum_l[:]
+        sa[buf[s[n - 1]]] = n - 1
+        buf[s[n - 1]] += 1
+        for i in range(n):
+            v = sa[i]
+            if v >= 1 and not ls[v - 1]:
+                sa[buf[s[v - 1]]] = v - 1
+                buf[s[v - 1]] += 1
+        # induce S-type suffixes right to left
+        buf = sum_l[:]
+        for i in range(n - 1, -1, -1):
+            v = sa[i]
+            if v >= 1 and ls[v - 1]:
+                buf[s[v - 1] + 1] -= 1
+                sa[buf[s[v - 1] + 1]] = v - 1
+
+    # lms_map gives the rank of each LMS position in text order, -1 otherwise
+    lms_map = [-1] * (n + 1)
+    lms = []
+    for i in range(1, n):
+        if not ls[i - 1] and ls[i]:
+            lms_map[i] = len(lms)
+            lms.append(i)
+    m = len(lms)
+
+    induce(lms)
+
+    if m:
+        # name the sorted LMS substrings, equal substrings share a name
+        sorted_lms = [v for v in sa if lms_map[v] != -1]
+        rec_s = [0] * m
+        rec_upper = 0
+        rec_s[lms_map[sorted_lms[0]]] = 0
+        for i in range(1, m):
+            left = sorted_lms[i - 1]
+            right = sorted_lms[i]
+            end_left = lms[lms_map[left] + 1] if lms_map[left] + 1 < m else n
+            end_right = lms[lms_map[right] + 1] if lms_map[right] + 1 < m else n
+            same = True
+            if end_left - left != end_right - right:
+                same = False
+            else:
+                while left < end_left:
+                    if s[left] != s[right]:
+                        break
+                    left += 1
+                    right += 1
+                if left == n or s[left] != s[right]:
+                    same = False
+            if not same:
+                rec_upper += 1
+            rec_s[lms_map[sorted_lms[i]]] = rec_upper
+
+        # recurse on the reduced string to get the true order of the LMS suffixes
+        rec_sa = sais(rec_s, rec_upper)
+        for i in range(m):
+            sorted_lms[i] = lms[rec_sa[i]]
+        induce(sorted_lms)
+
+    return sa
+
+
+def suffix_array_sais(s):
+    if not s:
+        return []
+    codes = [ord(char) for char in s]
+    return sais(codes, max(codes))
+
+
+## all the ways we know of building the suffix array, they must give the same order
+SUFFIX_ARRAY_ENGINES = {
+    "sais": suffix_array_sais,
+    "ukkonen": suffix_array_from_tree,
+}
+DEFAULT_ENGINE = "sais"
+
+
+def build_suffix_array(s, engine=DEFAULT_ENGINE):
+    try:
+        build = SUFFIX_ARRAY_ENGINES[engine]
+    except KeyError:
+        raise ValueError(f"unknown suffix array engine: {engine!r}") from None
+    return build(s)
+
+
+def stream_suffix_array(s, engine=DEFAULT_ENGINE):
+    ## yield the suffix array in rank order, for consumers that only need one pass
+    ## the tree engine never materializes the array at all
+    if engine == "ukkonen":
+        return iter_suffix_array(build_suffix_tree(s))
+    return iter(build_suffix_array(s, engine))
+
+
+def inverse_suffix_array(suffix_array):
+    ## isa[suffix start] = rank (0-based), the inverse permutation of the suffix array
+    inverse = array('i', bytes(4 * len(suffix_array)))
+    for rank, suffix_start in enumerate(suffix_array):
+        inverse[suffix_start] = rank
+    return inverse
+
+
+## on-disk rank index layout:
+##   magic (4 bytes) | version (1) | byte order (1, 0 little / 1 big) | padding (2) | n (8)
+##   suffix array, n int32 | inverse suffix array, n int32
+INDEX_MAGIC = b"SAIX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sBBxxQ")
+
+
+def build_rank_index(string_filename, index_filename, engine=DEFAULT_ENGINE):
+    ## build the SA and the inverse SA once and save them, so every later query
+    ## file against the same text skips the construction entirely
+    s = read_file(string_filename)
+    suffix_array = array('i', build_suffix_array(s, engine))
+    inverse = inverse_suffix_array(suffix_array)
+
+    with open(index_filename, 'wb') as file:
+        byte_order = 0 if sys.byteorder == "little" else 1
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, byte_order, len(s)))
+        suffix_array.tofile(file)
+        inverse.tofile(file)
+    return len(s)
+
+
+def check_position(position, n):
+    # array and memoryview indexing would take 0 and negative positions from the end
+    if not 1 <= position <= n:
+        raise ValueError(f"position {position} is outside 1..{n}")
+
+
+class RankIndex:
+    ## read-only view over a saved index, the arrays stay in the page cache
+    ## through the mmap and are never copied into python objects
+    def __init__(self, index_filename):
+        self.file = open(index_filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order, n = INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise ValueError(f"{index_filename} is not a suffix array index")
+        if byte_order != (0 if sys.byteorder == "little" else 1):
+            self.close()
+            raise ValueError(f"{index_filename} was written on a machine with a different byte order")
+        self.n = n
+        view = memoryview(self.map)
+        start = INDEX_HEADER.size
+        self.suffix_array = view[start:start + 4 * n].cast('i')
+        self.inverse = view[start + 4 * n:start + 8 * n].cast('i')
+
+    def check(self, position):
+        check_position(position, self.n)
+
+    def rank(self, position):
+        # 1-based position in, 1-based rank out, same as main
+        self.check(position)
+        return self.inverse[position - 1] + 1
+
+    def close(self):
+        if getattr(self, "suffix_array", None) is not None:
+            self.suffix_array.release()
+            self.inverse.release()
+            self.suffix_array = self.inverse = None
+        if not self.map.closed:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_positions(positions_filename):
+    ## positions are whitespace separated, read them a line at a time so a query
+    ## file with millions of positions is never held in memory
+    with open(positions_filename, 'r') as file:
+        for line in file:
+            for token in line.split():
+                yield int(token)
+
+
+def answer_rank_queries(index_filename, positions_filename, output_filename="output_q1.txt"):
+    with RankIndex(index_filename) as index, open(output_filename, 'w') as out:
+        inverse = index.inverse
+        count = 0
+        n = index.n
+        for position in iter_positions(positions_filename):
+            if not 1 <= position <= n:
+                check_position(position, n)
+            out.write(f"{inverse[position - 1] + 1}\n")
+            count += 1
+    return count
+
+
 def read_file(filename):
     with open(filename, 'r') as file:
         return file.read().strip()
@@ -230,24 +502,37 @@ def write_results(filename, results):
         for result in results:
             file.write(f"{result}\n")
 
-def main(string_filename, positions_filename):
+def main(string_filename, positions_filename, engine=DEFAULT_ENGINE):
     s = read_file(string_filename)
-    root = build_suffix_tree(s)
-    suffix_array = collect_suffix_array(root,s)
+    suffix_array = build_suffix_array(s, engine)
 
 
     ## we have the suffix array and the input, map them together.
     positions = list(map(int, read_file(positions_filename).split()))
-    position_ranks = {suffix_array[i]: i + 1 for i in range(len(suffix_array))}  # Create a map of suffix start to rank
+    position_ranks = inverse_suffix_array(suffix_array)  # suffix start -> 0-based rank
 
+    n = len(position_ranks)
+    for pos in positions:
+        if not 1 <= pos <= n:
+            check_position(pos, n)
     # adjusting for based 1
-    ranks = [position_ranks[pos - 1] for pos in positions]  # Adjust for 1-based index
+    ranks = [position_ranks[pos - 1] + 1 for pos in positions]  # Adjust for 1-based index
     write_results("output_q1.txt", ranks)
 
 
+USAGE = """Usage: python q1.py <stringFileName> <positionsFileName> [sais|ukkonen]
+       python q1.py index <stringFileName> <indexFileName> [sais|ukkonen]
+       python q1.py query <indexFileName> <positionsFileName> [outputFileName]"""
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python q1.py <stringFileName> <positionsFileName>")
+    if len(sys.argv) >= 2 and sys.argv[1] == "index" and len(sys.argv) in (4, 5):
+        build_rank_index(*sys.argv[2:])
+    elif len(sys.argv) >= 2 and sys.argv[1] == "query" and len(sys.argv) in (4, 5):
+        answer_rank_queries(*sys.argv[2:])
+    elif len(sys.argv) in (3, 4) and sys.argv[1] not in ("index", "query"):
+        main(*sys.argv[1:])
+    else:
+        print(USAGE)
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2])
 
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+from q1 import DEFAULT_ENGINE
+from q2_codec import compress, decompress
+from q2_encoder import DEFAULT_BLOCK_SIZE
+from q2_format import VERSION
+from q2_models import load_model
+
+## content addressed cache in front of the codec, for payloads that get compressed
+## (or decompressed) over and over
+##
+##   codec = CachedCodec(ByteCache(directory="cache", disk_budget=1 << 30))
+##   data = codec.compress(payload)       # the second time, no suffix sort at all
+##   codec.stats()                        # {"compress": {"memory_hits": ...}, ...}
+##
+## the key is a blake2b hash of the input plus every parameter that changes the
+## output, so a different block size or model never returns the wrong bytes. each
+## ByteCache has an LRU tier in memory and, with a directory, a second LRU tier on
+## disk; entries pushed out of memory stay on disk until its budget runs out
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+DEFAULT_DISK_BUDGET = 1024 * 1024 * 1024
+KEY_BYTES = 16
+
+COUNTERS = ("memory_hits", "disk_hits", "misses", "memory_evictions", "disk_evictions")
+
+
+def content_key(data, *params):
+    ## hex key for data under the given codec parameters
+    digest = hashlib.blake2b(digest_size=KEY_BYTES)
+    digest.update(repr(params).encode())
+    digest.update(b'\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class ByteCache:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, directory=None, disk_budget=DEFAULT_DISK_BUDGET):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.directory = directory
+        # key -> bytes, least recently used first
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        # key -> file size, least recently used first, rebuilt from file times at start
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load_disk_index()
+
+    def load_disk_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bin"):
+                status = os.stat(os.path.join(self.directory, name))
+                entries.append((status.st_mtime_ns, name[:-4], status.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+        self.evict_disk()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def get(self, key):
+        ## the cached bytes or None, a disk hit is promoted back into memory
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            return value
+        if key in self.disk:
+            try:
+                with open(self.path(key), 'rb') as file:
+                    value = file.read()
+            except FileNotFoundError:
+                # removed behind our back, forget it
+                self.disk_bytes -= self.disk.pop(key)
+            else:
+                self.disk.move_to_end(key)
+                os.utime(self.path(key))
+                self.counters["disk_hits"] += 1
+                self.put_memory(key, value)
+                return value
+        self.counters["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        value = bytes(value)
+        self.put_memory(key, value)
+        if self.directory is not None and key not in self.disk and len(value) <= self.disk_budget:
+            # written under a temp name and renamed, a reader never sees half a file
+            handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(handle, 'wb') as file:
+                file.write(value)
+            os.replace(temp_path, self.path(key))
+            self.disk[key] = len(value)
+            self.disk_bytes += len(value)
+            self.evict_disk()
+
+    def put_memory(self, key, value):
+        if len(value) > self.memory_budget:
+            return
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old)
+        self.memory[key] = value
+        self.memory_bytes += len(value)
+        while self.memory_bytes > self.memory_budget:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.counters["memory_evictions"] += 1
+
+    def evict_disk(self):
+        while self.disk_bytes > self.disk_budget:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            self.counters["disk_evictions"] += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+        hits = lookups - self.counters["misses"]
+        return dict(self.counters, lookups=lookups, hit_rate=hits / lookups if lookups else 0.0,
+                    memory_bytes=self.memory_bytes, disk_bytes=self.disk_bytes)
+
+
+class CachedCodec:
+    ## q2_codec.compress / decompress behind a cache each, either one can be None
+    def __init__(self, compress_cache=None, decompress_cache=None, block_size=DEFAULT_BLOCK_SIZE,
+                 engine=DEFAULT_ENGINE, canonical=True, model=None):
+        if isinstance(model, int):
+            model = load_model(model)
+        self.compress_cache = compress_cache
+        self.decompress_cache = decompress_cache
+        self.block_size = block_size
+        self.engine = engine
+        self.canonical = canonical
+        self.model = model
+
+    def compress_key(self, data):
+        # the engine does not change the output, every SA construction gives the same BWT
+        return content_key(data, "compress", VERSION, self.block_size, self.canonical,
+                           None if self.model is None else self.model.id)
+
+    def decompress_key(self, data):
+        # a container says how it was made, its bytes alone decide the output
+        return content_key(data, "decompress", VERSION)
+
+    def compress(self, data):
+        if self.compress_cache is None:
+            return compress(data, self.block_size, self.engine, 1, self.canonical, self.model)
+        key = self.compress_key(data)
+        result = self.compress_cache.get(key)
+        if result is None:
+            result = compress(data, self.block_size, self.engine, 1, self.canonical, self.model)
+            self.compress_cache.put(key, result)
+        return result
+
+    def decompress(self, data):
+        if self.decompress_cache is None:
+            return decompress(data)
+        key = self.decompress_key(data)
+        result = self.decompress_cache.get(key)
+        if result is None:
+            result = decompress(data)
+            self.decompress_cache.put(key, result)
+        return result
+
+    def stats(self):
+        return {name: cache.stats() for name, cache in (("compress", self.compress_cache),
+                                                        ("decompress", self.decompress_cache))
+                if cache is not None}
@@ -0,0 +1,179 @@
+from q1 import DEFAULT_ENGINE
+from q2_encoder import DEFAULT_BLOCK_SIZE, encode_blocks, stream_flags
+from q2_decoder import decode_block, decode_stream
+from q2_format import (HEADER, BLOCK_HEADER, BLOCK_END, FLAG_BLOCKS, FLAG_INDEX, STREAMED_LENGTH,
+                       pack_header, pack_block, pack_index, parse_header)
+from q2_models import load_model
+from q2_stats import NO_STATS
+
+## in-memory API over the block container, no temp files and no fixed file names
+##
+##   data = compress(b"some text")
+##   assert decompress(data) == b"some text"
+##
+##   compressor = Compressor()
+##   for chunk in chunks:
+##       out.write(compressor.compress(chunk))
+##   out.write(compressor.flush())
+##
+## bytes go through the codec as latin-1. blocks with bytes outside the codec
+## alphabet are stored as they are (BLOCK_STORED). the output is the same block
+## file q2_encoder.py writes in block mode
+
+
+class Compressor:
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, engine=DEFAULT_ENGINE, workers=1,
+                 canonical=True, model=None, length=None, stats=NO_STATS):
+        # length is the total input size if it is known up front, it goes in the
+        # header and the output is byte for byte what encoder() writes. without it
+        # the file is marked as streamed and ends in a BLOCK_END record
+        if isinstance(model, int):
+            model = load_model(model)
+        self.block_size = block_size
+        self.engine = engine
+        self.workers = workers
+        self.canonical = canonical
+        self.model = model
+        self.length = length
+        self.stats = stats
+        # input not encoded yet, kept as the chunks it came in and joined once a block
+        # is full, adding to one string would copy the whole buffer on every call
+        self.pending = []
+        self.pending_length = 0
+        self.consumed = 0
+        self.written = 0
+        self.entries = []
+        self.started = False
+        self.finished = False
+
+    def _header(self):
+        if self.started:
+            return b''
+        self.started = True
+        flags = stream_flags(self.canonical, self.model) | FLAG_BLOCKS | FLAG_INDEX
+        header = pack_header(flags, STREAMED_LENGTH if self.length is None else self.length)
+        self.written += len(header)
+        return header
+
+    def _encode(self, text):
+        pieces = [self._header()]
+        blocks = encode_blocks(text, self.block_size, self.engine, self.workers, self.stats,
+                               self.canonical, self.model)
+        for block_flags, block_length, payload in blocks:
+            self.entries.append((self.written, block_length, self.consumed))
+            record = pack_block(block_flags, block_length, payload)
+            pieces.append(record)
+            self.written += len(record)
+            self.consumed += block_length
+        return b''.join(pieces)
+
+    def compress(self, data):
+        ## returns the compressed bytes of every block that is complete so far, the
+        ## rest of data stays buffered until more arrives or flush()
+        if self.finished:
+            raise ValueError("compress() after flush()")
+        if data:
+            self.pending.append(bytes(data))
+            self.pending_length += len(data)
+        full = self.pending_length - self.pending_length % self.block_size
+        if not full:
+            return self._header() if self.pending_length else b''
+        buffered = b''.join(self.pending)
+        self.pending = [buffered[full:]] if len(buffered) > full else []
+        self.pending_length -= full
+        return self._encode(buffered[:full].decode('latin-1'))
+
+    def flush(self):
+        ## the last partial block, the end marker and the footer index. the
+        ## compressor is finished afterwards
+        if self.finished:
+            return b''
+        self.finished = True
+        text = b''.join(self.pending).decode('latin-1')
+        self.pending = []
+        self.pending_length = 0
+        if self.length is not None and self.consumed + len(text) != self.length:
+            raise ValueError(f"expected {self.length} bytes, got {self.consumed + len(text)}")
+        pieces = [self._encode(text)]
+        if self.length is None:
+            end = BLOCK_HEADER.pack(BLOCK_END, 0, 0)
+            pieces.append(end)
+            self.written += len(end)
+        pieces.append(pack_index(self.entries, self.written))
+        return b''.join(pieces)
+
+
+class Decompressor:
+    def __init__(self, stats=NO_STATS):
+        self.stats = stats
+        self.buffer = bytearray()
+        self.flags = None
+        self.length = None
+        self.produced = 0
+        # set once the last block has been decoded, anything after it is the footer
+        self.eof = False
+
+    def _blocks(self):
+        pieces = []
+        offset = 0
+        while not self.eof:
+            if self.length != STREAMED_LENGTH and self.produced >= self.length:
+                self.eof = True
+                break
+            if len(self.buffer) - offset < BLOCK_HEADER.size:
+                break
+            block_flags, block_length, payload_length = BLOCK_HEADER.unpack_from(self.buffer, offset)
+            if block_flags & BLOCK_END:
+                self.eof = True
+                break
+            end = offset + BLOCK_HEADER.size + payload_length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[offset + BLOCK_HEADER.size:end])
+            pieces.append(decode_block(block_flags, payload, self.stats, self.flags).encode('latin-1'))
+            self.produced += block_length
+            offset = end
+        del self.buffer[:offset]
+        if self.eof:
+            # the footer index, only needed for random access to a file
+            self.buffer.clear()
+        return b''.join(pieces)
+
+    def decompress(self, data):
+        ## returns the text of every block that has fully arrived
+        if self.eof:
+            return b''
+        self.buffer += data
+        if self.flags is None:
+            if len(self.buffer) < HEADER.size:
+                return b''
+            _, self.flags, self.length = parse_header(self.buffer)
+            del self.buffer[:HEADER.size]
+        if not self.flags & FLAG_BLOCKS:
+            # a single stream container can only be decoded once all of it is here
+            return b''
+        return self._blocks()
+
+    def flush(self):
+        ## whatever is left once the input has ended
+        if self.eof:
+            return b''
+        if self.flags is None:
+            raise ValueError("truncated container header")
+        if self.flags & FLAG_BLOCKS:
+            raise ValueError("compressed data ends in the middle of a block")
+        self.eof = True
+        text = decode_stream(bytes(self.buffer), self.stats, self.flags)
+        self.buffer.clear()
+        return text.encode('latin-1')
+
+
+def compress(data, block_size=DEFAULT_BLOCK_SIZE, engine=DEFAULT_ENGINE, workers=1,
+             canonical=True, model=None):
+    compressor = Compressor(block_size, engine, workers, canonical, model, length=len(data))
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data):
+    decompressor = Decompressor()
+    return decompressor.decompress(data) + decompressor.flush()
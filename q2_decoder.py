@@ -1,105 +1,246 @@
 from bitarray import bitarray
 import sys
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from functools import lru_cache
+try:
+    # optional, vectorized LF array when it is installed
+    import numpy as np
+except ImportError:
+    np = None
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from q2_format import (read_encoded_stream, read_header, is_container, read_block_at,
+                       read_block_index, FLAG_BLOCKS, FLAG_CANONICAL, FLAG_MODEL,
+                       BLOCK_SENTINEL_ADDED, BLOCK_HUFFMAN_ONLY, BLOCK_STORED)
+from q2_models import load_model, MODEL_CACHE_SIZE, MODEL_ID_BITS
+from q2_huffman import canonical_codes, CODE_LENGTH_BITS
+from q2_stats import PipelineStats, NO_STATS, pop_stats_option
+
+class BitReader:
+    ## a cursor over one buffer, nothing is sliced off or copied while reading.
+    ## bits can be a bitarray (read through its buffer, no copy) or anything
+    ## bytes-like (bytes, mmap, memoryview), bits are big endian within a byte
+    def __init__(self, bits, length=None, pos=0):
+        if isinstance(bits, bitarray):
+            # endian is a method before bitarray 3 and a property after
+            endian = bits.endian() if callable(bits.endian) else bits.endian
+            if endian != 'big':
+                raise ValueError("BitReader needs a big endian bitarray")
+            if length is None:
+                length = len(bits)
+        self.data = memoryview(bits).cast('B')
+        self.length = len(self.data) * 8 if length is None else length
+        self.pos = pos
+
+    def remaining(self):
+        return self.length - self.pos
+
+    def bits_at(self, pos, count):
+        ## `count` bits starting at pos as an int, zero padded past the end
+        available = min(count, self.length - pos)
+        if available <= 0:
+            return 0
+        first_byte = pos >> 3
+        last_byte = (pos + available + 7) >> 3
+        value = int.from_bytes(self.data[first_byte:last_byte], 'big')
+        # drop the bits after the ones we want, then the ones before
+        value >>= (last_byte << 3) - (pos + available)
+        value &= (1 << available) - 1
+        return value << (count - available)
+
+    def peek(self, count):
+        return self.bits_at(self.pos, count)
+
+    def read_bits(self, count):
+        value = self.bits_at(self.pos, count)
+        self.pos += count
+        return value
+
+    def skip(self, count):
+        self.pos += count
+
+    def only_zeros_left(self, pos=None):
+        pos = self.pos if pos is None else pos
+        # finish the partial byte bit by bit, then whole bytes at once
+        while pos < self.length and pos & 7:
+            if self.bits_at(pos, 1):
+                return False
+            pos += 1
+        full_bytes = self.length >> 3
+        if pos < full_bytes << 3 and any(self.data[pos >> 3:full_bytes]):
+            return False
+        pos = max(pos, full_bytes << 3)
+        return self.bits_at(pos, self.length - pos) == 0
+
+    def read_elias_omega(self):
+        # just checking for not crashing, nothing but the zero padding left
+        if self.only_zeros_left():
+            return 0
+
+        start = self.pos
+        readlen = 1
+        #keep traverse untill find an int or end of the stream
+        while self.pos + readlen <= self.length:
+            # first iter len alway = 1
+            component = self.read_bits(readlen)
+            # If MSB is 1, return it right away when we hit 1 as out first bit in the combination of bit
+            if component >> (readlen - 1):
+                return component
+            # If MSB is 0, flip to 1 and calculate new readlen, + 1 since we -1 when we encode
+            readlen = (component | (1 << (readlen - 1))) + 1
+
+        # If the loop exits without returning, raise an error or handle the case
+        self.pos = start
+        raise ValueError("Failed to decode the complete integer")
+
+    def read_symbol(self, table):
+        ## one lookup per table level, returns the char or None (cursor untouched)
+        ## when the bits here are not a codeword
+        start = self.pos
+        while True:
+            bits, entries = table
+            entry = entries[self.peek(bits)]
+            if entry is None:
+                self.pos = start
+                return None
+            char, value = entry
+            if char is not None:
+                if self.pos + value > self.length:
+                    self.pos = start
+                    return None
+                self.pos += value
+                return char
+            # long code, skip the bits this level resolved and look in the secondary table
+            self.pos += bits
+            table = value
 
 def elias_omega_decode(encoded):
-    # just checking for not crashing, invalid input
-    if not encoded.any() or len(encoded) == 0:
-        return 0, encoded  
+    ## kept for callers holding a bitarray, returns the int and the rest of the stream
+    reader = BitReader(encoded)
+    N = reader.read_elias_omega()
+    return N, encoded[reader.pos:]
 
-    pos = 0
-    readlen = 1
-    component = bitarray()
-
-    #keep traverse untill find an int or end of the stream
-    while pos + readlen <= len(encoded):
-        # first iter len alway = 1
-        component = encoded[pos:pos + readlen]
-        # move forward
-        pos += readlen
-
-        if component[0] == 1:  # If MSB is 1, return it right away when we hit 1 as out first bit in the combination of bit
-            N = int(component.to01(), 2)  # Convert bitarray to integer
-            return N, encoded[pos:]  # Return the decoded integer and the remainder of the stream
-
-        if component[0] == 0:  # If MSB is 0, flip to 1 and calculate new readlen
-            component[0] = 1  # Flip 0 to 1
-            readlen = int(component.to01(), 2) + 1  #convert the current combination into int and + 1 since we -1 when we encode
-
-    # If the loop exits without returning, raise an error or handle the case
-    raise ValueError("Failed to decode the complete integer")
-
-def decode_character_details(bitstream, num_distinct_chars):
+def decode_character_details(reader, num_distinct_chars):
     # a dictionaries of char detail
     char_details = {}
-    pos = 0
 
     # we only go for the number of unique character, no more or less base on the decode part of unique char
     for _ in range(num_distinct_chars):
-        
-        # Decode the 7-bit ASCII code
-        ascii_code = bitstream[pos:pos+7].to01()
-        char = chr(int(ascii_code, 2))
-        pos += 7
-
-        print(f"Decoded ASCII for '{char}': {ascii_code} using bits from pos {pos-7} to {pos}")
 
+        # Decode the 7-bit ASCII code
+        char = chr(reader.read_bits(7))
 
         # Decode the length of the Huffman codeword using Elias decoding
-        huffman_length, new_stream = elias_omega_decode(bitstream[pos:])
-        print(f"Decoded Huffman length for '{char}': {huffman_length} starting at pos {pos}")
-        pos += len(bitstream[pos:]) - len(new_stream)  # Update pos with the number of bits read
+        huffman_length = reader.read_elias_omega()
 
-        
         # Extract the Huffman codeword
-        huffman_codeword = new_stream[:huffman_length]
-        pos += huffman_length #udpate the position since we just traverse the huffman code bit
-        print(f"Decoded Huffman codeword for '{char}': {huffman_codeword.to01()} using bits from pos {pos-huffman_length} to {pos}")
+        huffman_codeword = reader.read_bits(huffman_length)
 
         # Store the results
-        char_details[char] = (huffman_length, huffman_codeword.to01())
-    #return the char detail with the remaining string
-    return char_details, bitstream[pos:]
-
-def decode_run_length_tuples(bitstream, char_details):
+        char_details[char] = (huffman_length, f"{huffman_codeword:0{huffman_length}b}" if huffman_length else "")
+    return char_details
 
-    decoded_sequence = []
-    pos = 0
+def decode_code_lengths(reader, num_distinct_chars):
+    ## canonical header, 7-bit ASCII + 4-bit code length per character, the codewords
+    ## are rebuilt from the lengths, same {char: (length, codeword)} shape as above
+    lengths = {}
+    for _ in range(num_distinct_chars):
+        char = chr(reader.read_bits(7))
+        lengths[char] = reader.read_bits(CODE_LENGTH_BITS)
+    return {char: (len(code), code) for char, code in canonical_codes(lengths).items()}
+
+## number of bits resolved by the first level of the decode table, codes longer
+## than this continue in a secondary table hanging off their first bits
+DECODE_TABLE_BITS = 8
+
+def build_decode_table(codes, table_bits=DECODE_TABLE_BITS):
+    ## codes is a list of (char, codeword string). returns (bits, entries) where
+    ## entries[next bits as int] is (char, code length) for a code that fits, or
+    ## (None, secondary table) for longer codes, or None when no code matches
+    longest = max(len(code) for _, code in codes)
+    bits = min(table_bits, longest)
+    entries = [None] * (1 << bits)
+    long_codes = {}
+
+    for char, code in codes:
+        if len(code) <= bits:
+            # every index starting with this code resolves to it
+            first = int(code, 2) << (bits - len(code)) if code else 0
+            for index in range(first, first + (1 << (bits - len(code)))):
+                entries[index] = (char, len(code))
+        else:
+            # group the long codes by their first bits, the rest goes one level down
+            long_codes.setdefault(int(code[:bits], 2), []).append((char, code[bits:]))
+
+    for prefix, suffixes in long_codes.items():
+        entries[prefix] = (None, build_decode_table(suffixes, table_bits))
+
+    return bits, entries
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def model_decode_table(model_id):
+    ## the decode table of a pretrained model, built once per model id and reused
+    ## by every stream that references it
+    char_details = load_model(model_id).char_details()
+    return build_decode_table([(char, code) for char, (_, code) in char_details.items()])
+
+def iter_run_length_tuples(reader, char_details, total_length=None, table=None):
+    ## yields the (char, run_length) pairs one at a time as they are read
+
+    decoded_length = 0
+    # lookup table built once from the codewords in the header, unless one is given
+    if table is None:
+        table = build_decode_table([(char, code) for char, (_, code) in char_details.items()])
 
     # decode untill we extracted all the run length detail or end of the stream
-    while pos < len(bitstream):
-        # bool to keep track and break the loop
-        found = False
-        for char, (huff_len, code) in char_details.items():
-            huffman_codeword = bitarray(code)  # extract the code in the char detail dictionaries
-            expected_codeword_length = len(huffman_codeword) # keep track of the traversed length 
-
-            # Check if the next segment in the bitstream matches this Huffman codeword
-            if bitstream[pos:pos + expected_codeword_length] == huffman_codeword:
-                # if matched, then incremented the position
-                pos += expected_codeword_length
-                # Now decode the Elias Omega encoded run length, which is followed back after back with the Huffman codeword
-                run_length, new_stream = elias_omega_decode(bitstream[pos:])
-                pos += (len(bitstream[pos:]) - len(new_stream))  # Update position after decoding run length
-                
-                decoded_sequence.append((char, run_length))
-                found = True
-                break
-        # we just need to traverse throught the part that related to run length, break after finished 
-        if not found:
+    while reader.remaining() > 0:
+        if total_length is not None and decoded_length >= total_length:
+            break
+        # resolve the huffman codeword at the cursor with a table lookup
+        char = reader.read_symbol(table)
+        # we just need to traverse throught the part that related to run length, break after finished
+        if char is None:
             break
+        # Now decode the Elias Omega encoded run length, which is followed back after back with the Huffman codeword
+        run_length = reader.read_elias_omega()
+        # only the zero padding is left
+        if run_length == 0:
+            break
+
+        yield char, run_length
+        decoded_length += run_length
 
-    return decoded_sequence, bitstream[pos:]
+def decode_run_length_tuples(reader, char_details, total_length=None, table=None):
+    return list(iter_run_length_tuples(reader, char_details, total_length, table))
 
 def reconstruct_from_run_length(run_length_tuples):
     # reconstruct the BWT word from the run length detail
-    reconstructed_string = ""
-    for char, length in run_length_tuples:
-        if length > 0:# since I decode the 0 that make up the bite
-            reconstructed_string += char * length
-
-    return reconstructed_string
+    return ''.join(char * length for char, length in run_length_tuples if length > 0)
 
-def decode_bwt_using_counting_sort(bwt):
+def expand_runs(run_length_tuples, total_length):
+    ## the runs written straight into one bytearray of the length from the header,
+    ## no list of runs and no intermediate string
+    bwt = bytearray(total_length)
+    run_bytes = {}
+    pos = 0
+    runs = 0
+    for char, length in run_length_tuples:
+        fill = run_bytes.get(char)
+        if fill is None:
+            fill = run_bytes[char] = char.encode('latin-1')
+        end = pos + length
+        if end > total_length:
+            raise ValueError("run lengths add up to more than the stream length")
+        bwt[pos:end] = fill * length
+        pos = end
+        runs += 1
+    if pos != total_length:
+        raise ValueError(f"stream ended after {pos} of {total_length} characters")
+    return bwt, runs
+
+def decode_bwt_using_counting_sort(bwt, verbose=False):
     ascii_min, ascii_max = 36, 126
     
     # a freq array, for stable counting sort rank
@@ -128,8 +269,9 @@ def decode_bwt_using_counting_sort(bwt):
             # the sum it from this point
             current_position += freq_array[i]
 
-    print(rank_tuples)
-    print(occurrences_array)
+    if verbose:
+        print(rank_tuples)
+        print(occurrences_array)
     
     # Transform rank_tuples into a dictionary for quick rank lookup
     rank_dict = dict(rank_tuples)
@@ -147,55 +289,493 @@ def decode_bwt_using_counting_sort(bwt):
     return ''.join(original)  # Remove the end marker if used
 
 
+def symbol_starts(bwt_bytes):
+    ## C array, the first row of each byte value in the sorted first column
+    counts = [0] * 256
+    for value, count in Counter(bwt_bytes).items():
+        counts[value] = count
+    starts = [0] * 256
+    total = 0
+    for value in range(256):
+        starts[value] = total
+        total += counts[value]
+    return starts
+
+## rows of the bwt scanned at a time while psi or LF is built with numpy, bounds the int64 temporaries
+PSI_CHUNK_ROWS = 64 * 1024
+
+def row_dtype(n):
+    return np.uint32 if n < 1 << 32 else np.uint64
+
+def iter_stable_rows(bwt_bytes):
+    ## the stable sort order of the bwt as (first sorted row, bwt rows) pieces: a
+    ## counting sort, one byte value and one slice of rows at a time. argsort would
+    ## hand back 8 bytes per row for the whole bwt at once
+    values = np.frombuffer(bwt_bytes, dtype=np.uint8)
+    # bincount casts its input to int64, so it is counted a slice at a time too
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, len(values), PSI_CHUNK_ROWS):
+        counts += np.bincount(values[start:start + PSI_CHUNK_ROWS], minlength=256)
+    row = 0
+    for value in np.flatnonzero(counts):
+        for start in range(0, len(values), PSI_CHUNK_ROWS):
+            rows = np.flatnonzero(values[start:start + PSI_CHUNK_ROWS] == value)
+            rows += start
+            yield row, rows
+            row += len(rows)
+
+def lf_array(bwt_bytes):
+    ## LF[i] = C[bwt[i]] + occurrences of bwt[i] before i, 4 bytes per row.
+    ## that is just the inverse of a stable sort of the bwt, so with numpy it is the
+    ## counting sort pieces scattered into a uint32 array, otherwise a counting sort
+    ## into an array('I')
+    n = len(bwt_bytes)
+    if np is not None:
+        lf = np.empty(n, dtype=row_dtype(n))
+        for row, rows in iter_stable_rows(bwt_bytes):
+            lf[rows] = np.arange(row, row + len(rows), dtype=lf.dtype)
+        return lf
+    next_row = symbol_starts(bwt_bytes)
+    lf = array('I', bytes(4 * n))
+    for i, value in enumerate(bwt_bytes):
+        lf[i] = next_row[value]
+        next_row[value] += 1
+    return lf
+
+def walk_lf(bwt_bytes, lf_row, start):
+    ## rebuild the text back to front, lf_row(i) gives the row of the previous character
+    n = len(bwt_bytes)
+    original = bytearray(n)
+    idx = start
+    for i in range(n - 1, -1, -1):
+        original[i] = bwt_bytes[idx]
+        idx = lf_row(idx)
+    return original
+
+## how much decoded text is handed to the output file at a time
+OUTPUT_CHUNK_BYTES = 64 * 1024
+
+def psi_array(bwt_bytes):
+    ## the inverse of the LF mapping, psi[LF[i]] = i, which is the stable sort order
+    ## of the bwt. walking it goes through the text front to back
+    n = len(bwt_bytes)
+    if np is not None:
+        psi = np.empty(n, dtype=row_dtype(n))
+        for row, rows in iter_stable_rows(bwt_bytes):
+            psi[row:row + len(rows)] = rows
+        return psi
+    next_row = symbol_starts(bwt_bytes)
+    psi = array('I', bytes(4 * n))
+    for i, value in enumerate(bwt_bytes):
+        psi[next_row[value]] = i
+        next_row[value] += 1
+    return psi
+
+def walk_psi(bwt_bytes, psi_row, start, length, chunk_size):
+    ## the text front to back from the row of its first character, in chunks of
+    ## chunk_size bytes. psi_row(i) gives the row of the next character
+    chunk = bytearray(min(chunk_size, length))
+    i = start
+    done = 0
+    while done < length:
+        size = min(chunk_size, length - done)
+        if size < len(chunk):
+            chunk = bytearray(size)
+        for k in range(size):
+            chunk[k] = bwt_bytes[i]
+            i = psi_row(i)
+        done += size
+        yield bytes(chunk)
+
+def iter_inverse_bwt(bwt_bytes, length=None, chunk_size=OUTPUT_CHUNK_BYTES):
+    ## the first `length` characters of the text (all of it by default) in chunks of
+    ## chunk_size bytes, so the caller can write them out without ever holding the text
+    n = len(bwt_bytes)
+    length = n if length is None else length
+    if not length:
+        return
+    psi = memoryview(psi_array(bwt_bytes))
+    # the row ending in $ is the whole text, its first character is at psi of that row
+    yield from walk_psi(bwt_bytes, psi.__getitem__, psi[bwt_bytes.index(b'$')], length, chunk_size)
+
+def inverse_bwt(bwt_bytes):
+    ## full LF array, fastest, ~4 bytes per character on top of input and output
+    if not bwt_bytes:
+        return bytearray()
+    lf = memoryview(lf_array(bwt_bytes))  # plain int indexing, also for numpy
+    # we alway start with $, since we know string will alway end with $
+    return walk_lf(bwt_bytes, lf.__getitem__, bwt_bytes.index(b'$'))
+
+## rank checkpoints come in two levels, the way q2_fmindex stores them: a uint32
+## count per present symbol every CHECKPOINT_SUPERBLOCK_ROWS rows and a uint16 count
+## since that superblock every interval rows, about 2 * distinct / interval bytes
+## per character
+CHECKPOINT_SUPERBLOCK_ROWS = 65536
+DEFAULT_CHECKPOINT_INTERVAL = 256
+
+def check_checkpoint_interval(interval):
+    # below the superblock size, so a uint16 count never overflows
+    if interval < 1 or interval >= CHECKPOINT_SUPERBLOCK_ROWS or CHECKPOINT_SUPERBLOCK_ROWS % interval:
+        raise ValueError(f"checkpoint interval {interval} has to divide {CHECKPOINT_SUPERBLOCK_ROWS} "
+                         f"and be smaller than it")
+
+def rank_checkpoints(bwt_bytes, interval=DEFAULT_CHECKPOINT_INTERVAL):
+    ## {value: (superblocks, counts)} for the byte values that actually occur.
+    ## superblocks[j] = occurrences of value in bwt[:j * CHECKPOINT_SUPERBLOCK_ROWS],
+    ## counts[k] = occurrences from the superblock before k * interval up to it
+    check_checkpoint_interval(interval)
+    per_superblock = CHECKPOINT_SUPERBLOCK_ROWS // interval
+    checkpoints = {value: (array('I'), array('H')) for value in set(bwt_bytes)}
+    totals = dict.fromkeys(checkpoints, 0)
+    since = totals
+    for k, block_start in enumerate(range(0, len(bwt_bytes) + 1, interval)):
+        if k % per_superblock == 0:
+            since = dict.fromkeys(checkpoints, 0)
+            for value, (superblocks, _) in checkpoints.items():
+                superblocks.append(totals[value])
+        for value, (_, counts) in checkpoints.items():
+            counts.append(since[value])
+        for value, count in Counter(bwt_bytes[block_start:block_start + interval]).items():
+            totals[value] += count
+            since[value] += count
+    return checkpoints
+
+def checkpoint_rank(bwt_bytes, checkpoints, interval, value, i):
+    ## occurrences of value in bwt[:i], value has to occur in the bwt
+    superblocks, counts = checkpoints[value]
+    return (superblocks[i // CHECKPOINT_SUPERBLOCK_ROWS] + counts[i // interval]
+            + bwt_bytes.count(value, i - i % interval, i))
+
+def checkpoint_select(bwt_bytes, checkpoints, interval, value, k):
+    ## row of occurrence k (from 0) of value in the bwt: the superblock and the
+    ## interval it is in by halving over the checkpoints, then halving with count
+    ## inside that interval
+    superblocks, counts = checkpoints[value]
+    j = bisect_right(superblocks, k) - 1
+    k -= superblocks[j]
+    per_superblock = CHECKPOINT_SUPERBLOCK_ROWS // interval
+    block = bisect_right(counts, k, j * per_superblock, min((j + 1) * per_superblock, len(counts))) - 1
+    k -= counts[block]
+    start = block * interval
+    if k < 8:
+        # few to skip, walking there with find is cheaper than halving
+        row = bwt_bytes.find(value, start)
+        for _ in range(k):
+            row = bwt_bytes.find(value, row + 1)
+        return row
+    low, high = start, min(start + interval, len(bwt_bytes)) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if bwt_bytes.count(value, start, middle + 1) > k:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def inverse_bwt_checkpointed(bwt_bytes, interval=DEFAULT_CHECKPOINT_INTERVAL):
+    ## same result as inverse_bwt without the n-entry LF array, every step counts the
+    ## rest of its rank from the nearest checkpoint instead (CPU for memory)
+    if not bwt_bytes:
+        return bytearray()
+    starts = symbol_starts(bwt_bytes)
+    checkpoints = rank_checkpoints(bwt_bytes, interval)
+
+    def lf_row(i):
+        value = bwt_bytes[i]
+        return starts[value] + checkpoint_rank(bwt_bytes, checkpoints, interval, value, i)
+
+    return walk_lf(bwt_bytes, lf_row, bwt_bytes.index(b'$'))
+
+def iter_inverse_bwt_checkpointed(bwt_bytes, length=None, chunk_size=OUTPUT_CHUNK_BYTES,
+                                  interval=DEFAULT_CHECKPOINT_INTERVAL):
+    ## iter_inverse_bwt without the psi array: psi of a row is a select over the rank
+    ## checkpoints, so the text streams out front to back and besides the bwt only
+    ## the checkpoints and one chunk are held
+    n = len(bwt_bytes)
+    length = n if length is None else length
+    if not length:
+        return
+    checkpoints = rank_checkpoints(bwt_bytes, interval)
+    values = sorted(checkpoints)
+    starts = symbol_starts(bwt_bytes)
+    first_rows = [starts[value] for value in values]
+
+    def psi_row(i):
+        slot = bisect_right(first_rows, i) - 1
+        return checkpoint_select(bwt_bytes, checkpoints, interval, values[slot], i - first_rows[slot])
+
+    yield from walk_psi(bwt_bytes, psi_row, psi_row(bwt_bytes.index(b'$')), length, chunk_size)
+
+## inverse BWT engines: "full" keeps a 4 byte per character array (psi, or LF when
+## the whole text is built in memory anyway), "checkpointed" keeps only the rank
+## checkpoints and counts from them on every step, slower but much smaller.
+## "checkpointed:<interval>" picks the checkpoint interval, a divisor of 65536
+INVERSE_ENGINES = ("full", "checkpointed")
+DEFAULT_INVERSE = "full"
+
+def parse_inverse(inverse):
+    ## (engine, checkpoint interval) of an inverse BWT engine name
+    engine, colon, interval = inverse.partition(':')
+    if engine not in INVERSE_ENGINES or (colon and engine != "checkpointed"):
+        raise ValueError(f"unknown inverse BWT engine {inverse!r}, use one of full, checkpointed, "
+                         f"checkpointed:<interval>")
+    if not colon:
+        return engine, DEFAULT_CHECKPOINT_INTERVAL
+    try:
+        interval = int(interval)
+    except ValueError:
+        raise ValueError(f"checkpoint interval {interval!r} in {inverse!r} is not a number") from None
+    check_checkpoint_interval(interval)
+    return engine, interval
+
+def check_inverse(inverse):
+    parse_inverse(inverse)
+
+def iter_inverse(bwt_bytes, length=None, chunk_size=OUTPUT_CHUNK_BYTES, inverse=DEFAULT_INVERSE):
+    ## iter_inverse_bwt through the chosen engine
+    engine, interval = parse_inverse(inverse)
+    if engine == "full":
+        return iter_inverse_bwt(bwt_bytes, length, chunk_size)
+    return iter_inverse_bwt_checkpointed(bwt_bytes, length, chunk_size, interval)
+
+def pop_inverse_option(argv):
+    ## pulls "--inverse <engine>" out of a command line, returns the engine
+    if "--inverse" not in argv:
+        return DEFAULT_INVERSE
+    index = argv.index("--inverse")
+    if index + 1 >= len(argv):
+        raise SystemExit("--inverse needs an engine name")
+    inverse = argv[index + 1]
+    del argv[index:index + 2]
+    check_inverse(inverse)
+    return inverse
+
 def read_input_file(filename):
     with open(filename, 'r') as file:
         return file.read().strip()
 
 def write_output_file(data, filename):
-    with open(filename, 'w') as file:
+    # latin-1, so every decoded character is written back as the byte it came from
+    with open(filename, 'w', encoding='latin-1', newline='') as file:
         file.write(data)
 
-def decode(input_file):
-    # Example usage:
-    encoded_data = read_input_file(input_file)
-    encoded_stream = bitarray(encoded_data)
-
-    #decoded the length of the word
-    decoded_value, remaining_stream = elias_omega_decode(encoded_stream)
-    print("Decoded Value:", decoded_value)
-    print("Remaining Stream:", remaining_stream.to01())
-
-    # decoded the length of the set of unique character
-    num_distinct_chars, remaining_stream = elias_omega_decode(remaining_stream)
-    print("Decoded Value:", num_distinct_chars)
-    print("Remaining Stream:", remaining_stream.to01())
-
-    #decode the character detail
-    char_details, remaining_stream = decode_character_details(remaining_stream, num_distinct_chars)
-    print("Character Details:", char_details)
-    print("Remaining Stream:", remaining_stream.to01())
-
-    #decode run lenght detail
-    run_length_tuples, remaining_stream = decode_run_length_tuples(remaining_stream, char_details)
-    print("Decoded Run-Length Sequence:", run_length_tuples)
-    print("Remaining Stream:", remaining_stream.to01())
-
-    # Reconstruct the string
-    reconstructed_bwt = reconstruct_from_run_length(run_length_tuples)
-    print("Reconstructed BWT String:", reconstructed_bwt)
+def read_stream_header(reader, stats=NO_STATS, flags=0):
+    ## (length, char_details, decode table or None) from the start of a stream, flags
+    ## are the container flags, they say which header layout the stream has
+    with stats.stage("header_decode") as stage:
+        #decoded the length of the word
+        decoded_value = reader.read_elias_omega()
+        table = None
+        if flags & FLAG_MODEL:
+            # a pretrained model instead of a table, its decode table is cached
+            model_id = reader.read_bits(MODEL_ID_BITS)
+            char_details = None
+            table = model_decode_table(model_id)
+        else:
+            # decoded the length of the set of unique character
+            num_distinct_chars = reader.read_elias_omega()
+            #decode the character detail
+            if flags & FLAG_CANONICAL:
+                char_details = decode_code_lengths(reader, num_distinct_chars)
+            else:
+                char_details = decode_character_details(reader, num_distinct_chars)
+            stage.items = num_distinct_chars
+    return decoded_value, char_details, table
+
+def decode_bwt(bits, stats=NO_STATS, flags=0):
+    ## one complete BWT -> huffman -> RLE stream (bitarray or packed bytes) back to the
+    ## BWT as bytes
+
+    # one cursor over the whole stream, every stage below reads from it in turn
+    reader = BitReader(bits)
+    decoded_value, char_details, table = read_stream_header(reader, stats, flags)
+
+    #decode run lenght detail, each run goes straight into the preallocated BWT
+    with stats.stage("rle_decode", bytes_in=reader.length // 8) as stage:
+        runs = iter_run_length_tuples(reader, char_details, decoded_value, table)
+        reconstructed_bwt, stage.items = expand_runs(runs, decoded_value)
+        stage.bytes_out = len(reconstructed_bwt)
+    return reconstructed_bwt
+
+def decode_stream(bits, stats=NO_STATS, flags=0, inverse=DEFAULT_INVERSE):
+    ## one complete stream back to text
+    check_inverse(inverse)
+    reconstructed_bwt = decode_bwt(bits, stats, flags)
 
     #invert the BWT to the origin string
-    original_text = decode_bwt_using_counting_sort(reconstructed_bwt)
-    print("Original Text:", original_text)
-
-    write_output_file(original_text, "q2_decoder_output.txt")
+    with stats.stage("inverse_bwt", bytes_in=len(reconstructed_bwt)) as stage:
+        engine, interval = parse_inverse(inverse)
+        if engine == "full":
+            original = inverse_bwt(reconstructed_bwt)
+        else:
+            original = inverse_bwt_checkpointed(reconstructed_bwt, interval)
+        original = original.decode('latin-1')
+        stage.bytes_out = len(original)
+    return original
+
+def decode_huffman_only(bits, stats=NO_STATS, flags=0):
+    ## a BLOCK_HUFFMAN_ONLY payload, the stream header and then one codeword per character
+    reader = BitReader(bits)
+    length, char_details, table = read_stream_header(reader, stats, flags)
+    if table is None:
+        table = build_decode_table([(char, code) for char, (_, code) in char_details.items()])
+    with stats.stage("huffman_decode", bytes_in=reader.length // 8) as stage:
+        text = bytearray(length)
+        for i in range(length):
+            char = reader.read_symbol(table)
+            if char is None:
+                raise ValueError(f"stream ended after {i} of {length} characters")
+            text[i] = ord(char)
+        stage.bytes_out = length
+    return text
+
+def decode_block_bytes(block_flags, payload, stats=NO_STATS, flags=0):
+    ## the text of a stored or huffman-only block, None for a BWT block
+    if block_flags & BLOCK_STORED:
+        return bytes(payload)
+    if block_flags & BLOCK_HUFFMAN_ONLY:
+        return bytes(decode_huffman_only(payload, stats, flags))
+    return None
+
+def iter_decode_stream(bits, stats=NO_STATS, flags=0, drop_sentinel=False, chunk_size=OUTPUT_CHUNK_BYTES,
+                       inverse=DEFAULT_INVERSE):
+    ## decode_stream as byte chunks, for writing to a file as they are produced
+    check_inverse(inverse)
+    reconstructed_bwt = decode_bwt(bits, stats, flags)
+    length = len(reconstructed_bwt) - 1 if drop_sentinel else len(reconstructed_bwt)
+    # the time between chunks includes whatever the caller does with them
+    with stats.stage("inverse_bwt", bytes_in=len(reconstructed_bwt)) as stage:
+        for chunk in iter_inverse(reconstructed_bwt, length, chunk_size, inverse):
+            yield chunk
+        stage.bytes_out = length
+
+def decode_block(block_flags, payload, stats=NO_STATS, flags=0, inverse=DEFAULT_INVERSE):
+    raw = decode_block_bytes(block_flags, payload, stats, flags)
+    if raw is not None:
+        return raw.decode('latin-1')
+    text = decode_stream(payload, stats, flags, inverse)
+    # the encoder added the terminator to this block, it was not in the input
+    if block_flags & BLOCK_SENTINEL_ADDED:
+        text = text[:-1]
+    return text
+
+def decode_block_at(input_file, offset, stats=NO_STATS, inverse=DEFAULT_INVERSE):
+    ## top level so a worker process can open the file and decode one block itself,
+    ## only the offset and the decoded text cross the process boundary
+    with stats.stage("container_read") as stage:
+        with open(input_file, 'rb') as file:
+            _, flags, _ = read_header(file)
+            block_flags, _, payload = read_block_at(file, offset)
+        stage.bytes_out = len(payload)
+    return decode_block(block_flags, payload, stats, flags, inverse)
+
+def decode_block_with_stats(input_file, offset, inverse=DEFAULT_INVERSE):
+    ## for worker processes, the counters come back with the text to be merged
+    stats = PipelineStats()
+    return decode_block_at(input_file, offset, stats, inverse), stats.as_dict()
+
+def read_block_file(input_file):
+    ## returns the block index of a block container, or None for a single stream file
+    if not is_container(input_file):
+        return None
+    with open(input_file, 'rb') as file:
+        _, flags, _ = read_header(file)
+        if not flags & FLAG_BLOCKS:
+            return None
+        return read_block_index(file, flags)
+
+def iter_decode_block_at(input_file, offset, stats=NO_STATS, inverse=DEFAULT_INVERSE):
+    ## decode_block_at as byte chunks
+    with stats.stage("container_read") as stage:
+        with open(input_file, 'rb') as file:
+            _, flags, _ = read_header(file)
+            block_flags, _, payload = read_block_at(file, offset)
+        stage.bytes_out = len(payload)
+    raw = decode_block_bytes(block_flags, payload, stats, flags)
+    if raw is not None:
+        yield raw
+        return
+    yield from iter_decode_stream(payload, stats, flags, bool(block_flags & BLOCK_SENTINEL_ADDED),
+                                  inverse=inverse)
+
+def decode_blocks(input_file, entries, workers=1, stats=NO_STATS, inverse=DEFAULT_INVERSE):
+    ## yields the decoded blocks in order, on a process pool unless workers == 1
+    offsets = [offset for offset, _, _ in entries]
+    if workers == 1 or len(offsets) <= 1:
+        for offset in offsets:
+            yield decode_block_at(input_file, offset, stats, inverse)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if stats is NO_STATS:
+            yield from pool.map(decode_block_at, repeat(input_file), offsets, repeat(NO_STATS), repeat(inverse))
+            return
+        for text, block_stats in pool.map(decode_block_with_stats, repeat(input_file), offsets,
+                                          repeat(inverse)):
+            stats.merge(block_stats)
+            yield text
+
+def decode_range(input_file, start, stop, inverse=DEFAULT_INVERSE):
+    ## the original text[start:stop], only the blocks covering that range are decoded
+    entries = read_block_file(input_file)
+    if entries is None:
+        raise ValueError(f"{input_file} has no blocks, random access needs block mode")
+    pieces = []
+    for offset, block_length, original_offset in entries:
+        block_end = original_offset + block_length
+        if block_end <= start or original_offset >= stop:
+            continue
+        text = decode_block_at(input_file, offset, inverse=inverse)
+        pieces.append(text[max(start - original_offset, 0):stop - original_offset])
+    return ''.join(pieces)
+
+def decode(input_file, output_filename="q2_decoder_output.txt", workers=1, stats=NO_STATS,
+           inverse=DEFAULT_INVERSE):
+    ## inverse picks the inverse BWT engine, "checkpointed" (or "checkpointed:<interval>")
+    ## trades CPU for memory
+    check_inverse(inverse)
+    entries = read_block_file(input_file)
+    if entries is not None and workers != 1 and len(entries) > 1:
+        # independent blocks, decoded on the pool and written in order as they come back
+        with open(output_filename, 'wb') as out:
+            for text in decode_blocks(input_file, entries, workers, stats, inverse):
+                with stats.stage("output_write", bytes_in=len(text)):
+                    out.write(text.encode('latin-1'))
+        return
+
+    # one block or stream at a time, its text goes out in chunks straight from the
+    # inverse BWT and is never held whole
+    with open(output_filename, 'wb') as out:
+        if entries is not None:
+            for offset, _, _ in entries:
+                for chunk in iter_decode_block_at(input_file, offset, stats, inverse):
+                    out.write(chunk)
+            return
+
+        # packed container, or the old ascii '0'/'1' files
+        with stats.stage("container_read") as stage:
+            flags, _, encoded_stream = read_encoded_stream(input_file)
+            stage.bytes_out = len(encoded_stream) // 8
+
+        for chunk in iter_decode_stream(encoded_stream, stats, flags, inverse=inverse):
+            out.write(chunk)
+
+USAGE = """Usage: python q2_decoder.py <binary_file> [workers] [--stats <jsonFile>] [--inverse full|checkpointed[:interval]]
+       python q2_decoder.py range <binary_file> <start> <stop> [--inverse full|checkpointed[:interval]]"""
 
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) != 2:
-        print("Usage: python q2_decoder.py <binary_file>")
+    stats_filename = pop_stats_option(sys.argv)
+    inverse = pop_inverse_option(sys.argv)
+    stats = PipelineStats() if stats_filename else NO_STATS
+    if len(sys.argv) == 5 and sys.argv[1] == "range":
+        text = decode_range(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), inverse)
+        write_output_file(text, "q2_decoder_output.txt")
+    elif len(sys.argv) in (2, 3) and sys.argv[1] != "range":
+        workers = int(sys.argv[2]) if len(sys.argv) == 3 else 1
+        decode(sys.argv[1], workers=workers, stats=stats, inverse=inverse)
+    else:
+        print(USAGE)
         sys.exit(1)
-
-    input_file = sys.argv[1]
-    decode(input_file)
\ No newline at end of file
+    if stats_filename:
+        stats.write_json(stats_filename)
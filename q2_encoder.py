@@ -1,23 +1,59 @@
 import sys
 import os
-from q1 import build_suffix_tree,collect_suffix_array
+from q1 import build_suffix_array, stream_suffix_array, DEFAULT_ENGINE
 from bitarray import bitarray
+try:
+    # optional, vectorized BWT and run extraction when it is installed
+    import numpy as np
+except ImportError:
+    np = None
 import heapq
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, deque
+from q2_format import (write_container, write_blocks, append_blocks, read_header, read_block_index,
+                       BLOCK_SENTINEL_ADDED, BLOCK_HUFFMAN_ONLY, BLOCK_STORED, FLAG_BLOCKS, FLAG_CANONICAL, FLAG_MODEL)
+from q2_huffman import package_merge, canonical_codes, MAX_CODE_LENGTH, CODE_LENGTH_BITS
+from q2_stats import PipelineStats, NO_STATS, pop_stats_option
+from q2_models import load_model, pop_model_option, MODEL_ID_BITS
+
+## default block size for block mode, in characters
+DEFAULT_BLOCK_SIZE = 500_000
 
 
 def compute_bwt_from_suffix_array(s, suffix_array):
-    n = len(s)
-    bwt = [''] * n
-    ## we loop over the character
-    for i in range(n):
-        # if it is 1, then we take the last string
-        if suffix_array[i] == 0:
-            bwt[i] = s[-1]  # Last character of the string
-        else:
-            #since it a cyclic, we take the current rank(suffix array) at that position - 1 
-            bwt[i] = s[suffix_array[i] - 1]
+    ## suffix_array can be any iterable in rank order (list, array('i') or the
+    ## generator from q1.stream_suffix_array), we only walk it once
+    bwt = []
+    for suffix_start in suffix_array:
+        # if it is 0, then we take the last character since it is cyclic,
+        # s[-1] does exactly that, otherwise the character before the suffix
+        bwt.append(s[suffix_start - 1])
     return ''.join(bwt)
 
+def compute_bwt_numpy(s, suffix_array):
+    ## the same BWT as compute_bwt_from_suffix_array as one gather over a uint8 view,
+    ## index -1 wraps to the last character just like s[-1]
+    s_arr = np.frombuffer(s.encode('latin-1'), dtype=np.uint8)
+    if isinstance(suffix_array, np.ndarray):
+        sa = suffix_array
+    elif hasattr(suffix_array, 'typecode'):
+        sa = np.frombuffer(suffix_array, dtype=np.int32)  # array('i'), no copy
+    else:
+        sa = np.array(suffix_array, dtype=np.int64)
+    return s_arr[(sa - 1) % len(s_arr)]
+
+def bwt_from_suffix_array(s, suffix_array):
+    ## BWT string from a materialized suffix array, vectorized when numpy is there
+    if np is None or not s:
+        return compute_bwt_from_suffix_array(s, suffix_array)
+    return compute_bwt_numpy(s, suffix_array).tobytes().decode('latin-1')
+
+def compute_bwt(s, engine=DEFAULT_ENGINE):
+    ## BWT string of s, vectorized when numpy is there, streaming otherwise
+    if np is None:
+        return compute_bwt_from_suffix_array(s, stream_suffix_array(s, engine))
+    return bwt_from_suffix_array(s, build_suffix_array(s, engine))
+
 def elias_omega_encode(N):
     if N < 1:
         raise ValueError("error")
@@ -44,6 +80,66 @@ def elias_omega_encode(N):
 
     return encoded
 
+## run lengths up to this get their elias omega code from a table, filled the first
+## time each value is seen, anything larger is encoded on demand
+ELIAS_CODEBOOK_SIZE = 65536
+ELIAS_CODEBOOK = [None] * (ELIAS_CODEBOOK_SIZE + 1)
+
+def elias_omega_code(N):
+    ## elias_omega_encode through the codebook, the returned bitarray is shared, don't modify it
+    if N <= ELIAS_CODEBOOK_SIZE:
+        code = ELIAS_CODEBOOK[N]
+        if code is None:
+            code = ELIAS_CODEBOOK[N] = elias_omega_encode(N)
+        return code
+    return elias_omega_encode(N)
+
+class BitWriter:
+    ## the encoder side of q2_decoder.BitReader, every part of a stream is appended
+    ## to one growing bitarray, no '0'/'1' strings in between
+    def __init__(self):
+        self.bits = bitarray()
+
+    def write(self, bits):
+        # a bitarray, or a '0'/'1' string for the odd fixed header field
+        self.bits.extend(bits)
+
+    def write_int(self, value, width):
+        self.bits.extend(f"{value:0{width}b}")
+
+    def write_elias_omega(self, N):
+        self.bits.extend(elias_omega_code(N))
+
+    def write_symbols(self, text, codewords):
+        ## one codeword per character, no runs
+        self.bits.encode(codewords, text)
+
+    def write_runs(self, run_length_tuples, codewords):
+        ## codewords maps char -> prebuilt bitarray, one lookup and two extends per run
+        extend = self.bits.extend
+        for char, length in run_length_tuples:
+            extend(codewords[char])
+            extend(elias_omega_code(length))
+
+    def flush_to(self, file):
+        ## writes out the whole bytes so far and keeps the last partial byte, so a
+        ## stream larger than memory can be written as it is produced
+        whole = len(self.bits) - len(self.bits) % 8
+        if whole:
+            file.write(self.bits[:whole].tobytes())
+            del self.bits[:whole]
+
+    def align(self):
+        # Ensure the bitstream is byte-aligned by padding with '0's if necessary
+        extra_bits = -len(self.bits) % 8
+        if extra_bits:
+            self.bits.extend('0' * extra_bits)
+        return self.bits
+
+def build_codewords(huffman_codes):
+    ## char -> bitarray for every character that has a code, built once per stream
+    return {chr(index + 36): bitarray(code) for index, code in enumerate(huffman_codes) if code}
+
 class Node:
     #huffman tree
     def __init__(self, char, freq):
@@ -100,7 +196,8 @@ def generate_huffman_codes(node, prefix="", codes=None):
     #stop condition
     if node.char is not None:
         index = ord(node.char) - 36
-        codes[index] = prefix
+        # a single distinct character still needs one bit, a zero length code can't be elias encoded
+        codes[index] = prefix or "0"
     else:
         generate_huffman_codes(node.left, prefix + "0", codes) # go to left child
         generate_huffman_codes(node.right, prefix + "1", codes) # go to right child 
@@ -122,29 +219,41 @@ def encode_distinct_char_count(bwt_string):
     encoded_count = elias_omega_encode(distinct_chars)
     return encoded_count.to01()
 
-def encode_character_details(bwt_string, huffman_codes):
-    # get a set of unique characters
-    distinct_chars = set(bwt_string)  
-    encoded_char_details = bitarray()
-
+def write_character_details(writer, distinct_chars, huffman_codes):
     for char in distinct_chars:
-        ascii_code = bitarray(f"{ord(char):07b}")  # 7-bit ASCII format for that unique character
-        huffman_code = bitarray(huffman_codes[ord(char) - 36])  # Get Huffman code, since huffman code was an array of ascii
-        huffman_length = elias_omega_encode(len(huffman_code))  # Elias for length of Huffman code
+        huffman_code = huffman_codes[ord(char) - 36]  # Get Huffman code, since huffman code was an array of ascii
 
         # Combine all parts for this character
-        encoded_char_details.extend(ascii_code)
-        encoded_char_details.extend(huffman_length)
-        encoded_char_details.extend(huffman_code)
+        writer.write_int(ord(char), 7)  # 7-bit ASCII format for that unique character
+        writer.write_elias_omega(len(huffman_code))  # Elias for length of Huffman code
+        writer.write(huffman_code)
 
-        # Debug output for each character
-        print(f"Character: {char}")
-        print("ASCII Code (7-bit):", ascii_code.to01())
-        print("Huffman Code Length (Elias ):", huffman_length.to01())
-        print("Huffman Code:", huffman_code.to01())
-        print("---")
+def encode_character_details(bwt_string, huffman_codes):
+    # get a set of unique characters
+    writer = BitWriter()
+    write_character_details(writer, set(bwt_string), huffman_codes)
+    return writer.bits.to01()
+
+def canonical_huffman_codes(heap, max_length=MAX_CODE_LENGTH):
+    ## code lengths by package-merge, codewords rebuilt canonically from the lengths,
+    ## returned in the same [36, 126] list layout as generate_huffman_codes
+    lengths = package_merge({node.char: node.freq for node in heap}, max_length)
+    codes = [''] * 91
+    for char, code in canonical_codes(lengths).items():
+        codes[ord(char) - 36] = code
+    return codes
 
-    return encoded_char_details.to01()
+def write_code_lengths(writer, distinct_chars, huffman_codes):
+    ## canonical header, 7-bit ASCII and a 4-bit code length per character in ASCII
+    ## order, the decoder rebuilds the codewords from the lengths
+    for char in sorted(distinct_chars):
+        writer.write_int(ord(char), 7)
+        writer.write_int(len(huffman_codes[ord(char) - 36]), CODE_LENGTH_BITS)
+
+def encode_code_lengths(bwt_string, huffman_codes):
+    writer = BitWriter()
+    write_code_lengths(writer, set(bwt_string), huffman_codes)
+    return writer.bits.to01()
 
 def generate_run_length_tuples(bwt_string):
     # checking for not crash
@@ -173,26 +282,28 @@ def generate_run_length_tuples(bwt_string):
 
     return run_length_tuples
 
-def encode_run_length_tuples(run_length_tuples, huffman_codes):
+def run_length_arrays(bwt_string):
+    ## numpy version of the run extraction, returns (symbols uint8, lengths int64)
+    arr = np.frombuffer(bwt_string.encode('latin-1'), dtype=np.uint8)
+    if not len(arr):
+        return arr, np.zeros(0, dtype=np.int64)
+    # a run starts at 0 and wherever the character changes
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(arr)) + 1))
+    lengths = np.diff(np.append(starts, len(arr)))
+    return arr[starts], lengths
+
+def run_length_tuples_of(bwt_string):
+    ## same list of (char, length) as generate_run_length_tuples
+    if np is None:
+        return generate_run_length_tuples(bwt_string)
+    symbols, lengths = run_length_arrays(bwt_string)
+    return list(zip(symbols.tobytes().decode('latin-1'), lengths.tolist()))
 
-    encoded_rle = bitarray()
-
-    for char, length in run_length_tuples:
-        huffman_code = bitarray(huffman_codes[ord(char) - 36])  # Huffman code for the character, since huffman code was store in an
-                                                                #array of ascii
-        run_length_code = elias_omega_encode(length)  # Elias Omega encoding for the run length
-
-        # add it by this order based on the format
-        encoded_rle.extend(huffman_code)
-        encoded_rle.extend(run_length_code)
-        # Print detailed information for debugging
-        # print(f"Character: {char}")
-        # print("Huffman Code:", huffman_code.to01())
-        # print(f"Run Length: {length}")
-        # print("Elias Omega Encoded Run Length:", run_length_code.to01())
-        # print("---")
-
-    return encoded_rle.to01()
+def encode_run_length_tuples(run_length_tuples, huffman_codes):
+    # Huffman code for the character then the Elias Omega encoded run length, for every run
+    writer = BitWriter()
+    writer.write_runs(run_length_tuples, build_codewords(huffman_codes))
+    return writer.bits.to01()
 
 
 def read_input_file(filename):
@@ -205,65 +316,283 @@ def write_output_file(data, filename):
     with open(filename, 'w') as file:
         file.write(data)
 
-def encoder(s):
-
-    # from the given string, build a suffix tree using ukkonen
-    root = build_suffix_tree(s)
-    # then get the suffix array from the suffix tree
-    suffix_array = collect_suffix_array(root, s)
-
-    # compute the BWT string
-    bwt_string = compute_bwt_from_suffix_array(s, suffix_array)
-    #encode it
-    encoded_bwt_length = encode_bwt_length(bwt_string)
-
-    encoded_distinct_chars = encode_distinct_char_count(bwt_string)
-
-    #calculate the frequencies, put it in a heapq for a sorted order, instant pop
-    heap = calculate_frequencies(s)
+def huffman_codes_for(heap, canonical=True, model=None):
+    if model is not None:
+        # nothing to build, the codes were trained ahead of time
+        return model.codes
+    if canonical:
+        return canonical_huffman_codes(heap)
     #build the suffix tree from the heap
     root = build_huffman_tree(heap)
     # then traverse the huffman_tree to extract the binary code
-    huffman_codes = generate_huffman_codes(root)
-
+    return generate_huffman_codes(root)
+
+def write_stream_header(writer, text, huffman_codes, canonical=True, model=None):
+    writer.write_elias_omega(len(text))
+    if model is not None:
+        # the model id takes the place of the distinct count and the code table
+        writer.write_int(model.id, MODEL_ID_BITS)
+        return
+    distinct_chars = set(text)
+    writer.write_elias_omega(len(distinct_chars))
     # encode the detail of the character
-    encoded_char_details = encode_character_details(bwt_string, huffman_codes)
-
-    # run length encoding
-    run_length_tuples = generate_run_length_tuples(bwt_string)
-    encoded_rle = encode_run_length_tuples(run_length_tuples, huffman_codes)
-
-    print("Encoded BWT Length:", encoded_bwt_length)
-    print("Encoded Distinct Characters Count:", encoded_distinct_chars)
-    print("Encoded Character Details:", encoded_char_details)
-    print("Run-Length Tuples:", run_length_tuples)
-    print("Encoded Run Length Tuples:", encoded_rle)
-
-
-    # Combine all encoded parts into a single bitstream
-    final_encoded_bitstream = bitarray()
-    final_encoded_bitstream.extend(encoded_bwt_length)
-    final_encoded_bitstream.extend(encoded_distinct_chars)
-    final_encoded_bitstream.extend(encoded_char_details)
-    final_encoded_bitstream.extend(encoded_rle)
-
-    # Ensure the bitstream is byte-aligned by padding with '0's if necessary
-    extra_bits = 8 - len(final_encoded_bitstream) % 8
-    if extra_bits < 8:
-        final_encoded_bitstream.extend('0' * extra_bits)
+    if canonical:
+        write_code_lengths(writer, distinct_chars, huffman_codes)
+    else:
+        write_character_details(writer, distinct_chars, huffman_codes)
+
+def encode_stream(s, engine=DEFAULT_ENGINE, stats=NO_STATS, canonical=True, model=None):
+    ## the full BWT -> huffman -> RLE bitstream for one string, byte aligned. with
+    ## canonical the header only has code lengths (FLAG_CANONICAL in the container),
+    ## otherwise the original header with every codeword spelled out. with a
+    ## pretrained q2_models.Model the header is just its id (FLAG_MODEL)
+
+    # from the given string, sort the suffixes, SA-IS by default or the ukkonen tree.
+    # without numpy the suffix array is streamed into the BWT one entry at a time (the
+    # tree engine never materializes it), so the bwt stage also times that walk
+    with stats.stage("suffix_sort", bytes_in=len(s)) as stage:
+        if np is None:
+            suffix_array = stream_suffix_array(s, engine)
+        else:
+            suffix_array = build_suffix_array(s, engine)
+        stage.items = len(s)
 
-    compressed_data = final_encoded_bitstream.to01()
+    # compute the BWT string
+    with stats.stage("bwt", bytes_in=len(s)) as stage:
+        bwt_string = bwt_from_suffix_array(s, suffix_array)
+        stage.bytes_out = len(bwt_string)
+    del suffix_array
 
-    print("Final Compressed Data:", compressed_data)
-    print("Length of Compressed Data:", len(compressed_data))
+    #calculate the frequencies, put it in a heapq for a sorted order, instant pop
+    if model is None:
+        with stats.stage("frequency_count", bytes_in=len(s)) as stage:
+            heap = calculate_frequencies(s)
+            stage.items = len(heap)
 
-    # Write the final compressed data to a binary output file
-    write_output_file(final_encoded_bitstream.to01(), 'q2_encoder_output.bin')
+    with stats.stage("huffman_build") as stage:
+        huffman_codes = huffman_codes_for(heap if model is None else None, canonical, model)
+        stage.items = sum(1 for code in huffman_codes if code)
 
+    # run length encoding
+    with stats.stage("rle", bytes_in=len(bwt_string)) as stage:
+        run_length_tuples = run_length_tuples_of(bwt_string)
+        stage.items = len(run_length_tuples)
+
+    with stats.stage("elias_packing") as stage:
+        #encode the header, then the runs, all into one buffer
+        writer = BitWriter()
+        write_stream_header(writer, bwt_string, huffman_codes, canonical, model)
+        writer.write_runs(run_length_tuples, build_codewords(huffman_codes))
+
+        final_encoded_bitstream = writer.align()
+        stage.items = len(run_length_tuples)
+        stage.bytes_out = len(final_encoded_bitstream) // 8
+
+    return final_encoded_bitstream
+
+def prepare_block(block):
+    ## the inverse BWT starts from the only '$', so every block must end in exactly one
+    if block.endswith('$') and block.count('$') == 1:
+        return block, 0
+    if '$' not in block:
+        return block + '$', BLOCK_SENTINEL_ADDED
+    raise ValueError("'$' can only appear once, at the very end of the input")
+
+def encode_huffman_only(text, stats=NO_STATS, canonical=True, model=None):
+    ## the stream header and then one codeword per character, no BWT and no RLE
+    if model is None:
+        with stats.stage("frequency_count", bytes_in=len(text)) as stage:
+            heap = calculate_frequencies(text)
+            stage.items = len(heap)
+
+    with stats.stage("huffman_build") as stage:
+        huffman_codes = huffman_codes_for(heap if model is None else None, canonical, model)
+        stage.items = sum(1 for code in huffman_codes if code)
+
+    with stats.stage("huffman_packing", bytes_in=len(text)) as stage:
+        writer = BitWriter()
+        write_stream_header(writer, text, huffman_codes, canonical, model)
+        writer.write_symbols(text, build_codewords(huffman_codes))
+        bitstream = writer.align()
+        stage.bytes_out = len(bitstream) // 8
+    return bitstream
+
+## blocks up to this size go through the BWT and are then checked against the
+## fallbacks, larger ones are judged on a sample of this many characters first
+ENTROPY_SAMPLE_SIZE = 16384
+# the BWT has to save at least this fraction over huffman-only to be worth its time
+BWT_MIN_GAIN = 0.05
+
+def choose_block_encoding(block, model=None):
+    ## cheap pre-pass before paying for a suffix sort. returns (block flag, huffman-only
+    ## size in bits): BLOCK_STORED when the block has characters outside the alphabet
+    ## or would not shrink at all, BLOCK_HUFFMAN_ONLY when the BWT of a sample of the
+    ## block has about one run per character, 0 for the full BWT pipeline
+    frequencies = Counter(block)
+    if any(not 36 <= ord(char) <= 126 for char in frequencies):
+        return BLOCK_STORED, None
+    lengths = model.lengths if model is not None else package_merge(frequencies)
+    # the exact huffman-only payload, plus about what its header costs
+    huffman_bits = 64 + 11 * len(frequencies) + sum(count * lengths[char] for char, count in frequencies.items())
+    stored_bits = 8 * len(block)
+    if huffman_bits >= stored_bits:
+        return BLOCK_STORED, huffman_bits
+    # the inverse BWT needs a lone '$' at the very end, blocks with more go without
+    if block.count('$') > (1 if block.endswith('$') else 0):
+        return BLOCK_HUFFMAN_ONLY, huffman_bits
+    if len(block) <= ENTROPY_SAMPLE_SIZE:
+        return 0, huffman_bits
+
+    # same run coding as encode_stream, over the BWT of the first sample characters
+    sample = block[:ENTROPY_SAMPLE_SIZE].rstrip('$')
+    sample_runs = run_length_tuples_of(compute_bwt(sample + '$'))
+    sample_bits = sum(lengths.get(char, MAX_CODE_LENGTH) + len(elias_omega_code(length))
+                      for char, length in sample_runs)
+    bwt_bits = sample_bits * len(block) / (len(sample) + 1)
+    if bwt_bits < huffman_bits * (1 - BWT_MIN_GAIN):
+        return 0, huffman_bits
+    return BLOCK_HUFFMAN_ONLY, huffman_bits
+
+def encode_block(block, engine=DEFAULT_ENGINE, stats=NO_STATS, canonical=True, model=None):
+    ## top level so it can be sent to a worker process, returns the block record
+    ## (block flags, original length, payload bytes) that write_blocks expects
+    with stats.stage("block_choice", bytes_in=len(block)):
+        block_flags, huffman_bits = choose_block_encoding(block, model)
+    if block_flags == 0:
+        text, block_flags = prepare_block(block)
+        payload = encode_stream(text, engine, stats, canonical, model).tobytes()
+        # the choice was only an estimate, the BWT payload still has to beat the fallbacks
+        if 8 * len(payload) < huffman_bits * (1 - BWT_MIN_GAIN):
+            return block_flags, len(block), payload
+        block_flags = BLOCK_HUFFMAN_ONLY
+    if block_flags == BLOCK_HUFFMAN_ONLY:
+        return block_flags, len(block), encode_huffman_only(block, stats, canonical, model).tobytes()
+    return BLOCK_STORED, len(block), block.encode('latin-1')
+
+def encode_block_with_stats(block, engine=DEFAULT_ENGINE, canonical=True, model=None):
+    ## for worker processes, the counters come back with the block to be merged
+    stats = PipelineStats()
+    return encode_block(block, engine, stats, canonical, model), stats.as_dict()
+
+## blocks handed to the pool ahead of the one being written, per worker. enough to
+## keep every worker busy while the head block finishes, and it bounds how many
+## blocks (and finished payloads waiting their turn) are held at once
+BLOCKS_IN_FLIGHT_PER_WORKER = 2
+
+def iter_blocks(s, block_size):
+    ## the blocks of s one slice at a time, never all of them at once
+    for start in range(0, len(s), block_size):
+        yield s[start:start + block_size]
+
+def encode_blocks(s, block_size=DEFAULT_BLOCK_SIZE, engine=DEFAULT_ENGINE, workers=None, stats=NO_STATS,
+                  canonical=True, model=None):
+    ## yields the encoded blocks in input order, compressed in parallel when there
+    ## is more than one block and more than one worker
+    if workers == 1 or len(s) <= block_size:
+        for block in iter_blocks(s, block_size):
+            yield encode_block(block, engine, stats, canonical, model)
+        return
+    window = BLOCKS_IN_FLIGHT_PER_WORKER * (workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+
+        def submit(block):
+            if stats is NO_STATS:
+                return pool.submit(encode_block, block, engine, NO_STATS, canonical, model)
+            return pool.submit(encode_block_with_stats, block, engine, canonical, model)
+
+        def finish(future):
+            if stats is NO_STATS:
+                return future.result()
+            record, block_stats = future.result()
+            stats.merge(block_stats)
+            return record
+
+        # a window of futures in input order, the next block is only submitted once
+        # the oldest one has been handed on
+        pending = deque()
+        try:
+            for block in iter_blocks(s, block_size):
+                if len(pending) >= window:
+                    yield finish(pending.popleft())
+                pending.append(submit(block))
+            while pending:
+                yield finish(pending.popleft())
+        finally:
+            # stopped early, the blocks nobody will take are not worth finishing
+            for future in pending:
+                future.cancel()
+
+def stream_flags(canonical=True, model=None):
+    ## container flags that tell the decoder how the stream headers look
+    if model is not None:
+        return FLAG_MODEL
+    return FLAG_CANONICAL if canonical else 0
+
+def encoder(s, engine=DEFAULT_ENGINE, block_size=None, workers=None,
+            output_filename='q2_encoder_output.bin', stats=NO_STATS, canonical=True, model=None):
+
+    # canonical huffman headers unless the original format is asked for, or a
+    # pretrained model (a q2_models.Model or its id) instead of any table at all
+    if isinstance(model, int):
+        model = load_model(model)
+    flags = stream_flags(canonical, model)
+
+    if block_size is not None:
+        # bzip2 style, every block is its own self contained stream
+        blocks = encode_blocks(s, block_size, engine, workers, stats, canonical, model)
+        write_blocks(output_filename, blocks, len(s), flags)
+        return
+
+    final_encoded_bitstream = encode_stream(s, engine, stats, canonical, model)
+
+    # Write the final compressed data to a binary output file, packed 8 bits per byte
+    with stats.stage("container_write", bytes_in=len(final_encoded_bitstream) // 8) as stage:
+        write_container(output_filename, final_encoded_bitstream, len(s), flags)
+        stage.bytes_out = os.path.getsize(output_filename)
+
+def append(s, filename='q2_encoder_output.bin', engine=DEFAULT_ENGINE, block_size=None, workers=None,
+           stats=NO_STATS, model=None):
+    ## adds s to the end of an existing block file. only s goes through the BWT,
+    ## as new blocks coded the way the file already is (canonical or original
+    ## headers, or a model, which has to be given again). returns the new length
+    if isinstance(model, int):
+        model = load_model(model)
+    with open(filename, 'rb') as file:
+        _, flags, _ = read_header(file)
+        if not flags & FLAG_BLOCKS:
+            raise ValueError(f"{filename} is a single stream file, only block files can be appended to")
+        entries = read_block_index(file, flags)
+    if bool(flags & FLAG_MODEL) != (model is not None):
+        raise ValueError(f"{filename} was {'' if flags & FLAG_MODEL else 'not '}written with a pretrained model")
+    if block_size is None:
+        # the archive's own block size, its first block is full unless it is the only one
+        block_size = entries[0][1] if len(entries) > 1 else DEFAULT_BLOCK_SIZE
+    blocks = encode_blocks(s, block_size, engine, workers, stats, bool(flags & FLAG_CANONICAL), model)
+    return append_blocks(filename, blocks)
+
+
+USAGE = ("Usage: python q2_encoder.py <stringFileName> [sais|ukkonen] [blockSize] [workers] "
+         "[--stats <jsonFile>] [--model <modelId>]\n"
+         "       python q2_encoder.py append <archive> <stringFileName> [blockSize] [workers] "
+         "[--stats <jsonFile>] [--model <modelId>]")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python q2_encoder.py <stringFileName>")
+    stats_filename = pop_stats_option(sys.argv)
+    model_option = pop_model_option(sys.argv)
+    stats = PipelineStats() if stats_filename else NO_STATS
+    if len(sys.argv) in (4, 5, 6) and sys.argv[1] == "append":
+        block_size = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        workers = int(sys.argv[5]) if len(sys.argv) > 5 else None
+        append(read_input_file(sys.argv[3]), sys.argv[2], block_size=block_size, workers=workers,
+               stats=stats, model=model_option)
+    elif len(sys.argv) in (2, 3, 4, 5) and sys.argv[1] != "append":
+        s = read_input_file(sys.argv[1])
+        engine = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_ENGINE
+        block_size = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        encoder(s, engine, block_size, workers, stats=stats, model=model_option)
+    else:
+        print(USAGE)
         sys.exit(1)
-    s = read_input_file(sys.argv[1])
-    encoder(s)
+    if stats_filename:
+        stats.write_json(stats_filename)
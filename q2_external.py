@@ -0,0 +1,403 @@
+import heapq
+import mmap
+import os
+import sys
+import tempfile
+from collections import Counter
+
+from q2_encoder import BitWriter, write_code_lengths, run_length_tuples_of, build_codewords
+from q2_format import pack_header, FLAG_CANONICAL
+from q2_huffman import package_merge, canonical_codes
+from q2_stats import PipelineStats, NO_STATS, pop_stats_option
+
+## external memory suffix sorting, for inputs that do not fit in RAM the way
+## q1.build_suffix_array needs them to
+##
+##   python q2_external.py <inputFile> [memoryBudget] [outputFile] [--stats <jsonFile>]
+##
+## the input is memory mapped, never read into a python string. the suffixes are
+## sorted by prefix doubling, every round one external merge sort of fixed width
+## records: runs as large as the memory budget allows are sorted and spilled to temp
+## files, then merged at most MAX_FAN_IN at a time. the final suffix order streams
+## straight into the BWT file, which is then huffman/RLE coded in two passes into a
+## normal single stream container, so the whole input gets one BWT
+##
+## the text is the file without trailing whitespace, with a '$' added at the end
+## when the file does not already end in one (the decoded output then ends in '$').
+## every other byte has to be in the codec alphabet, 36..126, which is checked
+## before any sorting starts
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# python overhead of one record while its run is sorted: the bytes object, its list
+# slot and the sort's merge space
+RECORD_OVERHEAD_BYTES = 48
+# runs merged at once, every one is an open file and a read buffer
+MAX_FAN_IN = 64
+# a merge never gives a run less read buffer than this, a small budget means a smaller fan-in
+MIN_RUN_BUFFER_BYTES = 64 * 1024
+# how much of the input, the names file or the BWT file is read at a time
+READ_BUFFER_BYTES = 1024 * 1024
+# the smallest piece the doubling rounds read the text and the names in
+MIN_PIECE_CHARS = 4096
+# the bytes the codec can encode
+ALPHABET = bytes(range(36, 127))
+
+
+class MappedText:
+    ## the input file as a read-only byte string of length n
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        end = size
+        while end and self.map[end - 1:end].isspace():
+            end -= 1
+        self.size = end
+        # the '$' terminator, real or added
+        self.added_sentinel = not end or self.map[end - 1:end] != b'$'
+        self.n = end + 1 if self.added_sentinel else end
+        if self.map.find(b'$', 0, end - (0 if self.added_sentinel else 1)) != -1:
+            self.close()
+            raise ValueError("'$' can only appear once, at the very end of the input")
+        self.check_alphabet()
+
+    def check_alphabet(self):
+        ## one pass over the input, so a newline in a huge file fails here and not
+        ## after hours of sorting
+        for start in range(0, self.size, READ_BUFFER_BYTES):
+            piece = self.map[start:min(start + READ_BUFFER_BYTES, self.size)]
+            outside = piece.translate(None, ALPHABET)
+            if outside:
+                offset = start + piece.index(outside[:1])
+                self.close()
+                raise ValueError(f"byte {outside[0]:#04x} at offset {offset} is outside the codec "
+                                 "alphabet (36..126), the input can not be encoded")
+
+    def piece(self, start, stop):
+        ## text[start:stop], the added '$' included
+        data = self.map[start:min(stop, self.size)] if start < self.size else b''
+        if self.added_sentinel and start <= self.size < stop:
+            data += b'$'
+        return data
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def name_width(n):
+    ## bytes per name and per position in the sort records, names go up to n
+    return max(1, (n.bit_length() + 7) // 8)
+
+
+def spill_run(records, directory):
+    ## sorts records (bytes of one fixed width) and writes them to a new run file
+    records.sort()
+    handle, filename = tempfile.mkstemp(dir=directory, suffix=".run")
+    with os.fdopen(handle, 'wb') as file:
+        file.writelines(records)
+    return filename
+
+
+def sort_into_runs(records, record_size, memory_budget, directory):
+    ## the first pass of the external sort: sorted runs of as many records as the
+    ## budget holds, returns their file names
+    per_run = max(1, memory_budget // (record_size + RECORD_OVERHEAD_BYTES))
+    runs = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= per_run:
+            runs.append(spill_run(chunk, directory))
+            chunk = []
+    if chunk or not runs:
+        runs.append(spill_run(chunk, directory))
+    return runs
+
+
+def merge_fan_in(memory_budget):
+    return max(2, min(MAX_FAN_IN, memory_budget // MIN_RUN_BUFFER_BYTES))
+
+
+def run_buffer_bytes(memory_budget, fan_in, record_size):
+    ## read buffer of every run in a merge, the budget shared by the runs and the output
+    share = memory_budget // (fan_in + 1)
+    return max(record_size, share - share % record_size)
+
+
+def read_run(filename, record_size, buffer_bytes):
+    with open(filename, 'rb') as file:
+        while True:
+            data = file.read(buffer_bytes)
+            if not data:
+                return
+            for start in range(0, len(data), record_size):
+                yield data[start:start + record_size]
+
+
+def merge_runs(runs, record_size, memory_budget, directory):
+    ## yields every record of the runs in sorted order. at most fan_in runs are open
+    ## at a time, more than that are merged in passes into fewer, longer runs first
+    fan_in = merge_fan_in(memory_budget)
+    buffer_bytes = run_buffer_bytes(memory_budget, fan_in, record_size)
+    while len(runs) > fan_in:
+        merged = []
+        for start in range(0, len(runs), fan_in):
+            group = runs[start:start + fan_in]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            handle, filename = tempfile.mkstemp(dir=directory, suffix=".run")
+            with os.fdopen(handle, 'wb') as out:
+                buffer = bytearray()
+                for record in heapq.merge(*[read_run(run, record_size, buffer_bytes) for run in group]):
+                    buffer += record
+                    if len(buffer) >= buffer_bytes:
+                        out.write(buffer)
+                        buffer.clear()
+                out.write(buffer)
+            for run in group:
+                os.remove(run)
+            merged.append(filename)
+        runs = merged
+    try:
+        yield from heapq.merge(*[read_run(run, record_size, buffer_bytes) for run in runs])
+    finally:
+        for run in runs:
+            os.remove(run)
+
+
+def piece_chars(memory_budget, width):
+    ## characters per piece in the doubling rounds. a piece is held as text, names
+    ## and shifted names at once, kept to a small slice of the budget
+    return max(MIN_PIECE_CHARS, min(READ_BUFFER_BYTES, memory_budget // (16 * (width + 1))))
+
+
+def iter_text_pieces(text, chars, start=0):
+    ## text[start:] chars at a time
+    while start < text.n:
+        stop = min(start + chars, text.n)
+        yield start, text.piece(start, stop)
+        start = stop
+
+
+def write_initial_names(text, names_filename, width, chars):
+    ## the first names are the characters themselves, all >= 36 so 0 stays free for
+    ## "past the end of the text". a name is width bytes big-endian, the character
+    ## goes in the last byte of each
+    with open(names_filename, 'wb') as out:
+        for _, piece in iter_text_pieces(text, chars):
+            if width == 1:
+                out.write(piece)
+            else:
+                names = bytearray(len(piece) * width)
+                names[width - 1::width] = piece
+                out.write(names)
+
+
+def iter_pair_records(text, names_filename, h, width, chars):
+    ## name[i] | name[i + h] | i | text[i - 1] for every suffix i, in text order.
+    ## sorting them orders the suffixes by their first 2h characters, and the last
+    ## byte is the BWT character of the suffix
+    with open(names_filename, 'rb') as names, open(names_filename, 'rb') as shifted:
+        shifted.seek(h * width)
+        for start, piece in iter_text_pieces(text, chars):
+            count = len(piece)
+            own = names.read(count * width)
+            ahead = shifted.read(count * width)
+            ahead += bytes(len(own) - len(ahead))
+            if start:
+                previous = text.piece(start - 1, start - 1 + count)
+            else:
+                previous = text.piece(text.n - 1, text.n) + piece[:-1]
+            for j in range(count):
+                low = j * width
+                yield (own[low:low + width] + ahead[low:low + width]
+                       + (start + j).to_bytes(width, 'big') + previous[j:j + 1])
+
+
+def iter_renamed(sorted_records, width, order_file, state, buffer_bytes):
+    ## new names from the sorted pair records: every suffix gets one plus the number
+    ## of suffixes that sort strictly before its 2h character prefix. yields
+    ## position | name records and writes position | bwt byte, in suffix order, to
+    ## order_file, which is the answer once every name is different
+    key_size = 2 * width
+    previous = None
+    name = 0
+    buffer = bytearray()
+    for rank, record in enumerate(sorted_records):
+        key = record[:key_size]
+        if key != previous:
+            name = rank + 1
+            previous = key
+        else:
+            state["unique"] = False
+        buffer += record[key_size:]
+        if len(buffer) >= buffer_bytes:
+            order_file.write(buffer)
+            buffer.clear()
+        yield record[key_size:key_size + width] + name.to_bytes(width, 'big')
+    order_file.write(buffer)
+
+
+def iter_suffix_order(text, memory_budget=DEFAULT_MEMORY_BUDGET, directory=None, stats=NO_STATS):
+    ## yields (suffix start, the byte before it) of the mapped text in sorted suffix
+    ## order. prefix doubling: round h sorts the suffixes by their first 2h characters
+    ## with an external merge sort and names them by rank, so ties are broken by
+    ## doubling h and never by comparing characters, however long the common prefix.
+    ## log2 of the longest repeat rounds, every one a few sequential passes on disk
+    width = name_width(text.n)
+    chars = piece_chars(memory_budget, width)
+    # the renaming pass merges one sort and fills the runs of the next at the same time
+    half_budget = memory_budget // 2
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        names_filename = os.path.join(tmp, "names")
+        order_filename = os.path.join(tmp, "order")
+        with stats.stage("external_sort", bytes_in=text.n) as stage:
+            write_initial_names(text, names_filename, width, chars)
+            h = 1
+            rounds = 0
+            while True:
+                rounds += 1
+                pair_size = 3 * width + 1
+                runs = sort_into_runs(iter_pair_records(text, names_filename, h, width, chars), pair_size,
+                                      memory_budget, tmp)
+                state = {"unique": True}
+                with open(order_filename, 'wb') as order_file:
+                    renamed = iter_renamed(merge_runs(runs, pair_size, half_budget, tmp), width,
+                                           order_file, state, chars)
+                    name_runs = sort_into_runs(renamed, 2 * width, half_budget, tmp)
+                if state["unique"]:
+                    for run in name_runs:
+                        os.remove(run)
+                    stage.items = rounds
+                    break
+                # the new names back in text order, for the next round
+                with open(names_filename, 'wb') as names:
+                    buffer = bytearray()
+                    for record in merge_runs(name_runs, 2 * width, memory_budget, tmp):
+                        buffer += record[width:]
+                        if len(buffer) >= chars:
+                            names.write(buffer)
+                            buffer.clear()
+                    names.write(buffer)
+                h *= 2
+        for record in read_run(order_filename, width + 1, chars * (width + 1)):
+            yield int.from_bytes(record[:width], 'big'), record[width]
+
+
+def iter_external_suffix_array(text, memory_budget=DEFAULT_MEMORY_BUDGET, directory=None, stats=NO_STATS):
+    ## yields every suffix start of the mapped text in sorted order
+    for position, _ in iter_suffix_order(text, memory_budget, directory, stats):
+        yield position
+
+
+def external_bwt(text, bwt_filename, memory_budget=DEFAULT_MEMORY_BUDGET, directory=None, stats=NO_STATS):
+    ## writes the BWT of the mapped text to bwt_filename, bwt[i] = text[sa[i] - 1]
+    with open(bwt_filename, 'wb') as out:
+        buffer = bytearray()
+        for _, value in iter_suffix_order(text, memory_budget, directory, stats):
+            buffer.append(value)
+            if len(buffer) >= READ_BUFFER_BYTES:
+                out.write(buffer)
+                buffer.clear()
+        out.write(buffer)
+    return text.n
+
+
+def iter_file_pieces(filename):
+    with open(filename, 'rb') as file:
+        while True:
+            piece = file.read(READ_BUFFER_BYTES)
+            if not piece:
+                return
+            yield piece
+
+
+def iter_runs(bwt_filename):
+    ## (char, length) runs of the BWT file, a run that crosses a read boundary is joined
+    pending = None
+    for piece in iter_file_pieces(bwt_filename):
+        runs = run_length_tuples_of(piece.decode('latin-1'))
+        if pending is not None:
+            if runs[0][0] == pending[0]:
+                runs[0] = (pending[0], pending[1] + runs[0][1])
+            else:
+                yield pending
+        yield from runs[:-1]
+        pending = runs[-1]
+    if pending is not None:
+        yield pending
+
+
+def encode_bwt_file(bwt_filename, n, output_filename, stats=NO_STATS):
+    ## the single stream container for a BWT on disk, written as it is produced.
+    ## same bitstream as q2_encoder.encode_stream with canonical codes
+    with stats.stage("frequency_count", bytes_in=n) as stage:
+        frequencies = Counter()
+        for piece in iter_file_pieces(bwt_filename):
+            frequencies.update(piece)
+        frequencies = {chr(value): count for value, count in frequencies.items()}
+        stage.items = len(frequencies)
+
+    with stats.stage("huffman_build") as stage:
+        huffman_codes = [''] * 91
+        for char, code in canonical_codes(package_merge(frequencies)).items():
+            huffman_codes[ord(char) - 36] = code
+        stage.items = len(frequencies)
+
+    with stats.stage("elias_packing", bytes_in=n) as stage:
+        with open(output_filename, 'wb') as file:
+            file.write(pack_header(FLAG_CANONICAL, n))
+            writer = BitWriter()
+            writer.write_elias_omega(n)
+            writer.write_elias_omega(len(frequencies))
+            write_code_lengths(writer, frequencies, huffman_codes)
+            codewords = build_codewords(huffman_codes)
+            runs = []
+            total_runs = 0
+            for run in iter_runs(bwt_filename):
+                runs.append(run)
+                if len(runs) == 65536:
+                    writer.write_runs(runs, codewords)
+                    writer.flush_to(file)
+                    total_runs += len(runs)
+                    runs.clear()
+            writer.write_runs(runs, codewords)
+            stage.items = total_runs + len(runs)
+            writer.align()
+            writer.flush_to(file)
+            stage.bytes_out = file.tell()
+
+
+def encode_file_external(input_filename, output_filename='q2_encoder_output.bin',
+                         memory_budget=DEFAULT_MEMORY_BUDGET, directory=None, stats=NO_STATS):
+    ## the whole file as one BWT stream, memory bounded by memory_budget (plus the
+    ## huffman and RLE buffers, which are fixed size)
+    with MappedText(input_filename) as text, tempfile.TemporaryDirectory(dir=directory) as tmp:
+        bwt_filename = os.path.join(tmp, "bwt")
+        n = external_bwt(text, bwt_filename, memory_budget, tmp, stats)
+        encode_bwt_file(bwt_filename, n, output_filename, stats)
+    return n
+
+
+USAGE = "Usage: python q2_external.py <inputFile> [memoryBudget] [outputFile] [--stats <jsonFile>]"
+
+if __name__ == "__main__":
+    stats_filename = pop_stats_option(sys.argv)
+    if len(sys.argv) not in (2, 3, 4):
+        print(USAGE)
+        sys.exit(1)
+    stats = PipelineStats() if stats_filename else NO_STATS
+    memory_budget = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_MEMORY_BUDGET
+    output_filename = sys.argv[3] if len(sys.argv) > 3 else 'q2_encoder_output.bin'
+    encode_file_external(sys.argv[1], output_filename, memory_budget, stats=stats)
+    if stats_filename:
+        stats.write_json(stats_filename)
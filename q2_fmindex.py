@@ -0,0 +1,418 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+from q2_decoder import (decode_bwt, decode_block_bytes, symbol_starts, rank_checkpoints, lf_array, read_block_file,
+                        check_checkpoint_interval, CHECKPOINT_SUPERBLOCK_ROWS)
+from q2_encoder import compute_bwt, run_length_tuples_of
+from q2_format import read_header, read_block_at, read_encoded_stream, BLOCK_SENTINEL_ADDED
+
+## FM-index over a compressed archive: count and locate a pattern with backward
+## search, without ever running the inverse BWT on the archive
+##
+##   python q2_fmindex.py build <archive> [indexFile]
+##   python q2_fmindex.py count <archive> <pattern>
+##   python q2_fmindex.py locate <archive> <pattern>
+##
+## the huffman and RLE stages are undone once per block to get its BWT back, then
+## rank checkpoints (Occ) and a sampled suffix array are built from it and saved
+## next to the archive (<archive>.fmi). count and locate go through the index,
+## which is rebuilt when the archive changes. every block is searched on its own,
+## so a match that crosses a block boundary is not found
+##
+## the checkpoints come in two levels, a uint32 count per present symbol every
+## SUPERBLOCK_ROWS rows and a uint16 count since the last superblock every interval
+## rows. the BWT itself is kept as (length, symbol) runs cut at interval boundaries
+## when that is smaller than the raw bytes, which it is for anything repetitive
+##
+## on-disk layout, all integers little or big endian as the byte order field says:
+##   magic (4) | version (1) | byte order (1) | padding (2) | checkpoint interval (4)
+##   | sample rate (4) | block count (4) | archive size (8) | archive mtime in ns (8)
+##   per block: data offset (8) | original offset (8) | original length (8)
+##              | bwt length (8) | sample count (4) | run count (4, 0 for a raw bwt)
+##              | block flags (1) | padding (3)
+##   per block data, uint32 unless noted, every array starts 4-byte aligned:
+##     C array (256) | checkpoint slot of each byte value (256, int32, -1 if absent)
+##     | superblock counts (slots * (bwt length // SUPERBLOCK_ROWS + 1))
+##     | sampled rows (sample count) | text positions of the sampled rows (sample count)
+##     | interval counts (slots * (bwt length // interval + 1), uint16)
+##     | raw bwt (bwt length bytes), or first run of every interval (bwt length // interval + 1)
+##       | run lengths (run count, uint16) | run symbols (run count bytes)
+FM_MAGIC = b"FMIX"
+FM_VERSION = 2
+FM_HEADER = struct.Struct("<4sBBxxIIIQQ")
+FM_BLOCK = struct.Struct("<QQQQIIBxxx")
+
+# rows between two checkpoints, the rank of a row is counted from its checkpoint,
+# over at most this many bytes (or the runs that cover them)
+DEFAULT_FM_INTERVAL = 256
+# rows between two full uint32 counts, the interval counts in between are relative
+# to it and fit in uint16. the decoder's rank checkpoints use the same layout
+SUPERBLOCK_ROWS = CHECKPOINT_SUPERBLOCK_ROWS
+# one suffix array entry is kept for every this many text positions, locate walks
+# at most this many LF steps per match
+DEFAULT_SAMPLE_RATE = 32
+
+
+def index_filename_for(archive):
+    return archive + ".fmi"
+
+
+def archive_stamp(archive):
+    status = os.stat(archive)
+    return status.st_size, status.st_mtime_ns
+
+
+def block_count(archive):
+    entries = read_block_file(archive)
+    return 1 if entries is None else len(entries)
+
+
+def archive_bwts(archive):
+    ## yields (original offset, original length, block flags, bwt bytes) for every
+    ## block, a single stream file is one block
+    entries = read_block_file(archive)
+    if entries is None:
+        flags, _, bitstream = read_encoded_stream(archive)
+        bwt = decode_bwt(bitstream, flags=flags)
+        yield 0, len(bwt), 0, bwt
+        return
+    with open(archive, 'rb') as file:
+        _, flags, _ = read_header(file)
+        for offset, block_length, original_offset in entries:
+            block_flags, _, payload = read_block_at(file, offset)
+            raw = decode_block_bytes(block_flags, payload, flags=flags)
+            if raw is None:
+                yield original_offset, block_length, block_flags, decode_bwt(payload, flags=flags)
+            else:
+                # stored and huffman-only blocks have no BWT, it is built here instead
+                yield (original_offset, block_length) + raw_block_bwt(raw, original_offset)
+
+
+def raw_block_bwt(raw, original_offset):
+    ## (block flags, bwt bytes) for the text of a block that was not BWT coded
+    if any(not 36 <= value <= 126 for value in set(raw)):
+        raise ValueError(f"the block at {original_offset} has bytes outside the codec alphabet, "
+                         "it cannot be indexed")
+    text = raw.decode('latin-1')
+    if text.endswith('$') and text.count('$') == 1:
+        return 0, compute_bwt(text).encode('latin-1')
+    if '$' in text:
+        raise ValueError(f"the block at {original_offset} has a '$' before its end, it cannot be indexed")
+    return BLOCK_SENTINEL_ADDED, compute_bwt(text + '$').encode('latin-1')
+
+
+def sample_suffix_array(bwt, sample_rate):
+    ## one LF walk from the row of the '$', the same walk the inverse BWT does. the
+    ## row reached after placing text[i] is the suffix starting at i, every row whose
+    ## position is a multiple of sample_rate is kept, sorted by row
+    n = len(bwt)
+    lf = memoryview(lf_array(bwt))
+    samples = []
+    row = bwt.index(b'$')
+    for position in range(n - 1, -1, -1):
+        row = lf[row]
+        if position % sample_rate == 0:
+            samples.append((row, position))
+    samples.sort()
+    return array('I', [row for row, _ in samples]), array('I', [position for _, position in samples])
+
+
+def interval_runs(bwt, interval):
+    ## (first run of every interval, run lengths, run symbols), runs never cross an
+    ## interval boundary so every interval can be walked on its own
+    first_run = array('I')
+    lengths = array('H')
+    symbols = bytearray()
+    row = 0
+    for char, length in run_length_tuples_of(bwt.decode('latin-1')):
+        value = ord(char)
+        while length:
+            if row % interval == 0:
+                first_run.append(len(lengths))
+            piece = min(length, interval - row % interval)
+            lengths.append(piece)
+            symbols.append(value)
+            row += piece
+            length -= piece
+    if len(bwt) % interval == 0:
+        # the checkpoint at the very end has no runs, its walk never reads any
+        first_run.append(len(lengths))
+    return first_run, lengths, symbols
+
+
+def write_aligned(file, data):
+    file.write(data)
+    file.write(bytes(-len(data) % 4))
+
+
+def write_fm_block(file, bwt, interval, sample_rate):
+    ## returns (sample count, run count), the run count is 0 when the raw bwt is kept
+    # already two-level, the same superblocks and counts the index stores
+    checkpoints = rank_checkpoints(bwt, interval)
+    slots = array('i', [-1] * 256)
+    superblocks = array('I')
+    counts = array('H')
+    for slot, value in enumerate(sorted(checkpoints)):
+        slots[value] = slot
+        superblocks.extend(checkpoints[value][0])
+        counts.extend(checkpoints[value][1])
+    rows, positions = sample_suffix_array(bwt, sample_rate)
+    first_run, lengths, symbols = interval_runs(bwt, interval)
+    for data in (array('I', symbol_starts(bwt)), slots, superblocks, rows, positions, counts):
+        write_aligned(file, data.tobytes())
+    # 3 bytes a run plus 4 an interval, against 1 a row for the raw bwt
+    if 3 * len(lengths) + 4 * len(first_run) < len(bwt):
+        write_aligned(file, first_run.tobytes())
+        write_aligned(file, lengths.tobytes())
+        write_aligned(file, symbols)
+        return len(rows), len(lengths)
+    write_aligned(file, bwt)
+    return len(rows), 0
+
+
+def build_fm_index(archive, index_filename=None, interval=DEFAULT_FM_INTERVAL,
+                   sample_rate=DEFAULT_SAMPLE_RATE):
+    # below SUPERBLOCK_ROWS too, the uint16 interval counts and run lengths hold
+    # at most interval - 1 or interval
+    check_checkpoint_interval(interval)
+    index_filename = index_filename or index_filename_for(archive)
+    size, mtime_ns = archive_stamp(archive)
+    count = block_count(archive)
+    records = []
+    with open(index_filename, 'wb') as file:
+        byte_order = 0 if sys.byteorder == "little" else 1
+        file.write(FM_HEADER.pack(FM_MAGIC, FM_VERSION, byte_order, interval, sample_rate,
+                                  count, size, mtime_ns))
+        # the block table goes first, its data offsets are filled in once known. the
+        # blocks are decoded and indexed one at a time, only one BWT is ever in memory
+        table_offset = file.tell()
+        file.write(bytes(FM_BLOCK.size * count))
+        for original_offset, block_length, block_flags, bwt in archive_bwts(archive):
+            data_offset = file.tell()
+            samples, runs = write_fm_block(file, bwt, interval, sample_rate)
+            records.append(FM_BLOCK.pack(data_offset, original_offset, block_length, len(bwt),
+                                         samples, runs, block_flags))
+            del bwt
+        file.seek(table_offset)
+        file.write(b''.join(records))
+    return index_filename
+
+
+class FMBlock:
+    ## backward search over one block, every array is a view into the index mmap
+    def __init__(self, view, interval, sample_rate, data_offset, original_offset, block_length,
+                 n, samples, runs, block_flags):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.original_offset = original_offset
+        self.block_length = block_length
+        self.block_flags = block_flags
+        self.n = n
+        self.offset = data_offset
+        self.views = []
+        self.starts = self.take(view, 256, 'I')
+        self.slots = self.take(view, 256, 'i')
+        slot_count = max(self.slots) + 1
+        self.superblocks_per_slot = n // SUPERBLOCK_ROWS + 1
+        self.superblocks = self.take(view, slot_count * self.superblocks_per_slot, 'I')
+        self.sampled_rows = self.take(view, samples, 'I')
+        self.sampled_positions = self.take(view, samples, 'I')
+        self.counts_per_slot = n // interval + 1
+        self.counts = self.take(view, slot_count * self.counts_per_slot, 'H')
+        self.runs = runs
+        if runs:
+            self.first_run = self.take(view, n // interval + 1, 'I')
+            self.run_lengths = self.take(view, runs, 'H')
+            self.run_symbols = self.take(view, runs, 'B')
+        else:
+            self.bwt = self.take(view, n, 'B')
+
+    def take(self, view, count, typecode):
+        ## the next array of the block data, as a view
+        size = count * struct.calcsize(typecode)
+        piece = view[self.offset:self.offset + size].cast(typecode)
+        self.offset += size + (-size % 4)
+        self.views.append(piece)
+        return piece
+
+    def interval_occ(self, value, block, i):
+        ## occurrences of value in bwt[block * interval:i]
+        start = block * self.interval
+        if not self.runs:
+            return self.bwt[start:i].tobytes().count(value)
+        remaining = i - start
+        count = 0
+        run = self.first_run[block]
+        while remaining > 0:
+            length = self.run_lengths[run]
+            if self.run_symbols[run] == value:
+                count += length if length < remaining else remaining
+            remaining -= length
+            run += 1
+        return count
+
+    def symbol(self, row):
+        ## bwt[row]
+        if not self.runs:
+            return self.bwt[row]
+        run = self.first_run[row // self.interval]
+        remaining = row % self.interval
+        while remaining >= self.run_lengths[run]:
+            remaining -= self.run_lengths[run]
+            run += 1
+        return self.run_symbols[run]
+
+    def occ(self, value, i):
+        ## occurrences of value in bwt[:i]
+        slot = self.slots[value]
+        if slot < 0:
+            return 0
+        block = i // self.interval
+        return (self.superblocks[slot * self.superblocks_per_slot + i // SUPERBLOCK_ROWS]
+                + self.counts[slot * self.counts_per_slot + block]
+                + self.interval_occ(value, block, i))
+
+    def lf(self, row):
+        value = self.symbol(row)
+        return self.starts[value] + self.occ(value, row)
+
+    def backward_search(self, pattern):
+        ## (first row, end row) of the suffixes that start with pattern
+        low, high = 0, self.n
+        for value in reversed(pattern):
+            if self.slots[value] < 0:
+                return 0, 0
+            low = self.starts[value] + self.occ(value, low)
+            high = self.starts[value] + self.occ(value, high)
+            if low >= high:
+                return 0, 0
+        return low, high
+
+    def position(self, row):
+        ## text position of the suffix in row, LF steps back to the nearest sample
+        steps = 0
+        while True:
+            index = bisect_left(self.sampled_rows, row)
+            if index < len(self.sampled_rows) and self.sampled_rows[index] == row:
+                return self.sampled_positions[index] + steps
+            row = self.lf(row)
+            steps += 1
+
+    def locate(self, pattern):
+        low, high = self.backward_search(pattern)
+        positions = []
+        for row in range(low, high):
+            position = self.position(row)
+            # a match that runs into the '$' the encoder added is not in the input
+            if self.block_flags & BLOCK_SENTINEL_ADDED and position + len(pattern) > self.block_length:
+                continue
+            positions.append(self.original_offset + position)
+        return positions
+
+    def count(self, pattern):
+        if b'$' in pattern:
+            return len(self.locate(pattern))
+        low, high = self.backward_search(pattern)
+        return high - low
+
+
+class FMIndex:
+    def __init__(self, index_filename):
+        self.file = open(index_filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blocks = []
+        self.view = None
+        (magic, version, byte_order, interval, sample_rate, count,
+         self.archive_size, self.archive_mtime_ns) = FM_HEADER.unpack_from(self.map, 0)
+        if magic != FM_MAGIC:
+            self.close()
+            raise ValueError(f"{index_filename} is not an FM-index")
+        if version != FM_VERSION:
+            self.close()
+            raise ValueError(f"{index_filename} is an FM-index of version {version}, not {FM_VERSION}")
+        if byte_order != (0 if sys.byteorder == "little" else 1):
+            self.close()
+            raise ValueError(f"{index_filename} was written on a machine with a different byte order")
+        self.view = memoryview(self.map)
+        for i in range(count):
+            record = FM_BLOCK.unpack_from(self.map, FM_HEADER.size + i * FM_BLOCK.size)
+            self.blocks.append(FMBlock(self.view, interval, sample_rate, *record))
+
+    def matches(self, archive):
+        ## False when the archive changed since the index was built
+        return archive_stamp(archive) == (self.archive_size, self.archive_mtime_ns)
+
+    def count(self, pattern):
+        pattern = pattern.encode('latin-1') if isinstance(pattern, str) else pattern
+        if not pattern:
+            return 0
+        return sum(block.count(pattern) for block in self.blocks)
+
+    def locate(self, pattern):
+        ## sorted offsets of every match in the original text
+        pattern = pattern.encode('latin-1') if isinstance(pattern, str) else pattern
+        if not pattern:
+            return []
+        positions = []
+        for block in self.blocks:
+            positions.extend(block.locate(pattern))
+        return sorted(positions)
+
+    def close(self):
+        for block in self.blocks:
+            for view in block.views:
+                view.release()
+        self.blocks = []
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if not self.map.closed:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_fm_index(archive, index_filename=None):
+    ## the saved index of an archive, (re)built first if it is missing or stale
+    index_filename = index_filename or index_filename_for(archive)
+    if os.path.exists(index_filename):
+        try:
+            index = FMIndex(index_filename)
+        except ValueError:
+            # written by another version of this module, or not an index at all
+            index = None
+        if index is not None:
+            if index.matches(archive):
+                return index
+            index.close()
+    build_fm_index(archive, index_filename)
+    return FMIndex(index_filename)
+
+
+USAGE = """Usage: python q2_fmindex.py build <archive> [indexFile]
+       python q2_fmindex.py count <archive> <pattern>
+       python q2_fmindex.py locate <archive> <pattern>"""
+
+
+if __name__ == "__main__":
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "build":
+        build_fm_index(*sys.argv[2:])
+    elif len(sys.argv) == 4 and sys.argv[1] in ("count", "locate"):
+        with open_fm_index(sys.argv[2]) as index:
+            if sys.argv[1] == "count":
+                print(index.count(sys.argv[3]))
+            else:
+                for position in index.locate(sys.argv[3]):
+                    print(position)
+    else:
+        print(USAGE)
+        sys.exit(1)
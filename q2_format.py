@@ -0,0 +1,223 @@
+import os
+import struct
+from bitarray import bitarray
+
+## the container that wraps an encoded bitstream on disk
+##
+##   magic (4 bytes) | version (1) | flags (1) | original length (8, little endian)
+##   packed bitstream, 8 bits per byte, zero padded to a whole byte
+##
+## files written before the container existed are the bitstream as ascii '0'/'1'
+## text with no header, read_encoded_stream still understands those
+##
+## with FLAG_BLOCKS set the payload is instead a sequence of independent blocks,
+## each one a block header followed by its own packed bitstream:
+##
+##   block flags (1) | original length (4) | payload length in bytes (4)
+##
+## the encoder picks per block between the full BWT stream, huffman-only and
+## storing the block as is, the block flags say which one it is
+##
+## and with FLAG_INDEX a footer after the last block lists where every block is,
+## so a reader can jump straight to the blocks it needs:
+##
+##   per block: byte offset of its header (8) | original length (8) | original offset (8)
+##   trailer:   byte offset of the first entry (8) | block count (4) | index magic (4)
+##
+## a streamed file (q2_codec.Compressor) does not know its length when the header
+## goes out, it stores STREAMED_LENGTH there instead and ends the block sequence
+## with a BLOCK_END header (no payload) just before the footer
+##
+## append_blocks adds blocks to the end of an existing block file: the end marker
+## and footer are written again after the new blocks and the header's original
+## length is updated in place, every byte of the old blocks stays where it was
+MAGIC = b"BWTH"
+VERSION = 1
+HEADER = struct.Struct("<4sBBQ")
+BLOCK_HEADER = struct.Struct("<BII")
+INDEX_ENTRY = struct.Struct("<QQQ")
+INDEX_TRAILER = struct.Struct("<QI4s")
+INDEX_MAGIC = b"BIDX"
+STREAMED_LENGTH = 0xFFFFFFFFFFFFFFFF
+
+# file flags
+FLAG_BLOCKS = 0x01
+FLAG_INDEX = 0x02
+FLAG_CANONICAL = 0x04  # stream headers carry canonical code lengths, not codewords
+FLAG_MODEL = 0x08  # stream headers carry the id of a pretrained model (q2_models)
+
+# block flags
+BLOCK_SENTINEL_ADDED = 0x01  # the encoder appended the '$', drop it after decoding
+BLOCK_HUFFMAN_ONLY = 0x02  # the payload is the stream header and one codeword per character, no BWT/RLE
+BLOCK_STORED = 0x04  # the payload is the block itself as latin-1 bytes
+BLOCK_END = 0x80  # no block, the end of a streamed block sequence
+
+
+def write_container(filename, bitstream, original_length, flags=0):
+    with open(filename, 'wb') as file:
+        file.write(pack_header(flags, original_length))
+        # tofile pads the last byte with zeros, the stream knows its own length
+        bitstream.tofile(file)
+
+
+def pack_header(flags, original_length):
+    return HEADER.pack(MAGIC, VERSION, flags, original_length)
+
+
+def pack_block(block_flags, block_length, payload):
+    return BLOCK_HEADER.pack(block_flags, block_length, len(payload)) + payload
+
+
+def pack_index(entries, index_offset):
+    ## the footer for blocks listed as (byte offset, original length, original offset),
+    ## index_offset is where in the file the footer itself starts
+    return b''.join([INDEX_ENTRY.pack(*entry) for entry in entries]
+                    + [INDEX_TRAILER.pack(index_offset, len(entries), INDEX_MAGIC)])
+
+
+def write_blocks(filename, blocks, original_length, flags=0):
+    ## blocks is an iterable of (block flags, original length, payload bytes), written
+    ## as they arrive so the encoder never holds the whole output
+    with open(filename, 'wb') as file:
+        file.write(pack_header(flags | FLAG_BLOCKS | FLAG_INDEX, original_length))
+        entries = []
+        original_offset = 0
+        for block_flags, block_length, payload in blocks:
+            entries.append((file.tell(), block_length, original_offset))
+            file.write(pack_block(block_flags, block_length, payload))
+            original_offset += block_length
+        write_index(file, entries)
+
+
+def write_index(file, entries):
+    file.write(pack_index(entries, file.tell()))
+
+
+def append_blocks(filename, blocks):
+    ## writes blocks after the last block of an existing block file, then the end
+    ## marker and footer again, and the new original length into the header. the
+    ## old blocks are not read or moved. returns the new original length
+    #
+    # blocks may be a generator doing the encoding, it is run to the end before the
+    # file is touched, so a failed encode leaves the archive as it was. that holds
+    # the new blocks in memory, never the old ones
+    blocks = list(blocks)
+    with open(filename, 'r+b') as file:
+        _, flags, original_length = read_header(file)
+        if not flags & FLAG_BLOCKS:
+            raise ValueError(f"{filename} is a single stream file, only block files can be appended to")
+        entries = read_block_index(file, flags)
+        end = HEADER.size
+        original_offset = 0
+        if entries:
+            offset, block_length, original_offset = entries[-1]
+            file.seek(offset)
+            _, _, payload_length = BLOCK_HEADER.unpack(file.read(BLOCK_HEADER.size))
+            end = offset + BLOCK_HEADER.size + payload_length
+            original_offset += block_length
+        # the old end marker and footer, put back if writing fails half way
+        file.seek(end)
+        old_tail = file.read()
+        try:
+            # the new blocks go over the old end marker and footer
+            file.seek(end)
+            for block_flags, block_length, payload in blocks:
+                entries.append((file.tell(), block_length, original_offset))
+                file.write(pack_block(block_flags, block_length, payload))
+                original_offset += block_length
+            if original_length == STREAMED_LENGTH:
+                file.write(BLOCK_HEADER.pack(BLOCK_END, 0, 0))
+            if flags & FLAG_INDEX:
+                write_index(file, entries)
+            file.truncate()
+            if original_length != STREAMED_LENGTH:
+                file.seek(0)
+                file.write(pack_header(flags, original_offset))
+        except BaseException:
+            file.seek(end)
+            file.write(old_tail)
+            file.truncate()
+            file.seek(0)
+            file.write(pack_header(flags, original_length))
+            raise
+    return original_offset
+
+
+def read_block_at(file, offset):
+    ## returns (block flags, original length, payload bytes) of the block at offset
+    file.seek(offset)
+    raw = file.read(BLOCK_HEADER.size)
+    if len(raw) < BLOCK_HEADER.size:
+        raise ValueError("truncated block header")
+    block_flags, block_length, payload_length = BLOCK_HEADER.unpack(raw)
+    payload = file.read(payload_length)
+    if len(payload) < payload_length:
+        raise ValueError("truncated block payload")
+    return block_flags, block_length, payload
+
+
+def read_block_index(file, flags):
+    ## list of (byte offset, original length, original offset), one per block
+    if flags & FLAG_INDEX:
+        file.seek(-INDEX_TRAILER.size, os.SEEK_END)
+        index_offset, count, magic = INDEX_TRAILER.unpack(file.read(INDEX_TRAILER.size))
+        if magic != INDEX_MAGIC:
+            raise ValueError("block index footer is missing or damaged")
+        file.seek(index_offset)
+        raw = file.read(count * INDEX_ENTRY.size)
+        return [INDEX_ENTRY.unpack_from(raw, i * INDEX_ENTRY.size) for i in range(count)]
+
+    # block files from before the footer existed, hop from header to header
+    entries = []
+    original_offset = 0
+    end = file.seek(0, os.SEEK_END)
+    offset = HEADER.size
+    while offset < end:
+        file.seek(offset)
+        raw = file.read(BLOCK_HEADER.size)
+        if len(raw) < BLOCK_HEADER.size:
+            raise ValueError("truncated block header")
+        block_flags, block_length, payload_length = BLOCK_HEADER.unpack(raw)
+        if block_flags & BLOCK_END:
+            break
+        entries.append((offset, block_length, original_offset))
+        offset += BLOCK_HEADER.size + payload_length
+        original_offset += block_length
+    return entries
+
+
+def parse_header(raw):
+    ## (version, flags, original length) from the first HEADER.size bytes of a container
+    if len(raw) < HEADER.size or not raw.startswith(MAGIC):
+        raise ValueError("not a BWT container")
+    magic, version, flags, original_length = HEADER.unpack_from(raw)
+    if version > VERSION:
+        raise ValueError(f"unsupported container version {version}")
+    return version, flags, original_length
+
+
+def read_header(file):
+    ## returns (version, flags, original length) and leaves the file at the payload
+    return parse_header(file.read(HEADER.size))
+
+
+def is_container(filename):
+    with open(filename, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def read_legacy_stream(filename):
+    ## the old one byte per bit ascii format
+    with open(filename, 'r') as file:
+        return bitarray(file.read().strip())
+
+
+def read_encoded_stream(filename):
+    ## returns (flags, original length or None for legacy files, bitstream)
+    if not is_container(filename):
+        return 0, None, read_legacy_stream(filename)
+    with open(filename, 'rb') as file:
+        _, flags, original_length = read_header(file)
+        bitstream = bitarray()
+        bitstream.fromfile(file)
+    return flags, original_length, bitstream
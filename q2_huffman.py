@@ -0,0 +1,51 @@
+from collections import Counter
+
+## canonical, length limited huffman codes, shared by the encoder and decoder.
+## only the code length of each symbol goes in the stream header, both sides
+## rebuild the exact same codewords from the lengths alone
+
+# longest codeword we ever hand out, also what fits in the 4-bit length field
+MAX_CODE_LENGTH = 15
+CODE_LENGTH_BITS = 4
+
+
+def package_merge(frequencies, max_length=MAX_CODE_LENGTH):
+    ## optimal code lengths with no code longer than max_length (Larmore & Hirschberg).
+    ## frequencies is {symbol: count}, returns {symbol: length}
+    symbols = sorted(frequencies, key=lambda symbol: (frequencies[symbol], symbol))
+    if not symbols:
+        return {}
+    if len(symbols) == 1:
+        # a lone symbol still needs one bit
+        return {symbols[0]: 1}
+    if len(symbols) > 1 << max_length:
+        raise ValueError(f"{len(symbols)} symbols do not fit in codes of at most {max_length} bits")
+
+    leaves = [(frequencies[symbol], (symbol,)) for symbol in symbols]
+    current = leaves
+    for _ in range(max_length - 1):
+        # pair up neighbours into packages, then merge them back with the leaves
+        packages = [(current[i][0] + current[i + 1][0], current[i][1] + current[i + 1][1])
+                    for i in range(0, len(current) - 1, 2)]
+        current = sorted(leaves + packages, key=lambda item: item[0])
+
+    # every time a symbol shows up in the cheapest 2n - 2 items its code gets one bit longer
+    lengths = Counter()
+    for _, members in current[:2 * len(symbols) - 2]:
+        lengths.update(members)
+    return dict(lengths)
+
+
+def canonical_codes(lengths):
+    ## {symbol: length} -> {symbol: codeword string}, shorter codes first and ties
+    ## broken by symbol, each code is the previous one + 1, shifted to its length
+    codes = {}
+    code = 0
+    previous_length = 0
+    for symbol in sorted(lengths, key=lambda symbol: (lengths[symbol], symbol)):
+        length = lengths[symbol]
+        code <<= length - previous_length
+        codes[symbol] = format(code, f"0{length}b")
+        code += 1
+        previous_length = length
+    return codes
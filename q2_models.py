@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import sys
+from collections import Counter
+from functools import lru_cache
+
+from q2_huffman import package_merge, canonical_codes, MAX_CODE_LENGTH
+
+## pretrained huffman models for lots of small, similar messages. a model is a set
+## of canonical code lengths trained once over a sample corpus and saved under its
+## id, streams then carry the 32-bit id (FLAG_MODEL) instead of their own table
+##
+##   python q2_models.py train <modelDir> <corpusFile> [<corpusFile> ...]
+
+# where models are looked up when no directory is given
+DEFAULT_MODEL_DIR = os.environ.get("Q2_MODEL_DIR", "models")
+# how many decoded models the decoder keeps ready
+MODEL_CACHE_SIZE = 32
+# every character the codec can carry, so a model can encode any input
+ALPHABET = [chr(code) for code in range(36, 127)]
+MODEL_ID_BITS = 32
+
+
+class Model:
+    def __init__(self, lengths):
+        self.lengths = dict(lengths)
+        # same [36, 126] list layout as q2_encoder.generate_huffman_codes
+        self.codes = [''] * 91
+        for char, code in canonical_codes(self.lengths).items():
+            self.codes[ord(char) - 36] = code
+        self.id = model_id(self.lengths)
+
+    def char_details(self):
+        ## {char: (length, codeword)}, what the decoder builds its lookup table from
+        return {char: (len(self.codes[ord(char) - 36]), self.codes[ord(char) - 36]) for char in self.lengths}
+
+
+def model_id(lengths):
+    ## the id is a hash of the code lengths, so the same model always gets the same id
+    canonical = ''.join(f"{char}{lengths[char]:02d}" for char in sorted(lengths))
+    return int.from_bytes(hashlib.sha256(canonical.encode('ascii')).digest()[:4], 'big')
+
+
+def train_model(texts, max_length=MAX_CODE_LENGTH):
+    ## texts is any iterable of sample strings. every character of the alphabet gets
+    ## a count of at least one so that unseen characters are still encodable
+    frequencies = Counter(dict.fromkeys(ALPHABET, 1))
+    for text in texts:
+        frequencies.update(text)
+    unknown = set(frequencies) - set(ALPHABET)
+    if unknown:
+        raise ValueError(f"characters outside the codec alphabet: {''.join(sorted(unknown))!r}")
+    return Model(package_merge(frequencies, max_length))
+
+
+def model_path(model_id, model_dir=None):
+    return os.path.join(model_dir or DEFAULT_MODEL_DIR, f"{model_id:08x}.json")
+
+
+def save_model(model, model_dir=None):
+    os.makedirs(model_dir or DEFAULT_MODEL_DIR, exist_ok=True)
+    path = model_path(model.id, model_dir)
+    with open(path, 'w') as file:
+        json.dump({"id": model.id, "lengths": model.lengths}, file, sort_keys=True)
+    return path
+
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_model(model_id, model_dir=None):
+    try:
+        with open(model_path(model_id, model_dir), 'r') as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        raise ValueError(f"unknown huffman model {model_id:08x}") from None
+    model = Model(data["lengths"])
+    if model.id != model_id:
+        raise ValueError(f"model file for {model_id:08x} does not match its id")
+    return model
+
+
+def pop_model_option(argv):
+    ## pulls "--model <hex id>" out of a command line, returns the id or None
+    if "--model" not in argv:
+        return None
+    index = argv.index("--model")
+    if index + 1 >= len(argv):
+        raise SystemExit("--model needs a model id")
+    model = int(argv[index + 1], 16)
+    del argv[index:index + 2]
+    return model
+
+
+def main(argv):
+    if len(argv) < 4 or argv[1] != "train":
+        print("Usage: python q2_models.py train <modelDir> <corpusFile> [<corpusFile> ...]")
+        return 1
+
+    def texts():
+        for filename in argv[3:]:
+            with open(filename, 'r') as file:
+                for line in file:
+                    yield line.strip()
+
+    model = train_model(texts())
+    save_model(model, argv[2])
+    print(f"{model.id:08x}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,390 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from q2_cache import ByteCache, CachedCodec
+from q2_codec import compress, decompress
+from q2_encoder import DEFAULT_BLOCK_SIZE
+
+## the codec as a long running local service, so callers skip interpreter startup
+## and the q1/numpy imports on every call
+##
+##   python q2_service.py --socket /tmp/q2.sock --workers 4
+##   python q2_service.py --port 7878
+##   python q2_service.py --port 7878 --cache-memory 64 --cache-dir /var/cache/q2
+##
+## every message is a frame, a fixed header followed by the payload:
+##
+##   request:  op (1) | request id (4) | payload length (4) | payload
+##   response: status (1) | request id (4) | payload length (4) | payload
+##
+## a connection can have many requests in flight, responses carry the request id
+## and may come back out of order. requests from all connections go through one
+## bounded queue; when it is full the server stops reading from the sockets, so
+## clients feel the backpressure as slow writes. small requests are batched so one
+## trip to a worker process carries several of them. with a cache (q2_cache) a
+## payload seen before is answered from it without going near the queue. hashing
+## payloads and the cache's disk reads and writes run on a thread of their own, the
+## event loop only waits for them. the stats op answers with the request, batch and
+## cache counters as json, and the service prints them when it shuts down
+
+FRAME = struct.Struct("<BII")
+
+OP_COMPRESS = 1
+OP_DECOMPRESS = 2
+OP_STATS = 3  # the payload is ignored, the answer is json
+
+STATUS_OK = 0
+STATUS_ERROR = 1  # the payload is the error message, utf-8
+
+# larger frames are refused and the connection is closed
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+DEFAULT_QUEUE_SIZE = 256
+# a batch is sent off once it has this many requests or bytes, or the wait is over
+BATCH_MAX_REQUESTS = 32
+BATCH_MAX_BYTES = 256 * 1024
+BATCH_WAIT_SECONDS = 0.002
+
+
+def run_batch(requests, block_size=DEFAULT_BLOCK_SIZE):
+    ## runs in a worker process, requests is a list of (op, payload) and the result
+    ## a list of (status, payload) in the same order
+    results = []
+    for op, payload in requests:
+        try:
+            if op == OP_COMPRESS:
+                results.append((STATUS_OK, compress(payload, block_size)))
+            elif op == OP_DECOMPRESS:
+                results.append((STATUS_OK, decompress(payload)))
+            else:
+                results.append((STATUS_ERROR, f"unknown op {op}".encode()))
+        except Exception as error:
+            results.append((STATUS_ERROR, f"{type(error).__name__}: {error}".encode()))
+    return results
+
+
+async def read_frame(reader):
+    ## (op or status, request id, payload), or None once the peer has closed
+    try:
+        header = await reader.readexactly(FRAME.size)
+        kind, request_id, length = FRAME.unpack(header)
+        if length > MAX_FRAME_BYTES:
+            raise ValueError(f"frame of {length} bytes is over the {MAX_FRAME_BYTES} byte limit")
+        return kind, request_id, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        # closed between frames, or part way through one, either way nothing more comes
+        return None
+
+
+def pack_frame(kind, request_id, payload):
+    return FRAME.pack(kind, request_id, len(payload)) + payload
+
+
+def fail(future, message=b"service is shutting down"):
+    if not future.done():
+        future.set_result((STATUS_ERROR, message))
+
+
+class CompressionService:
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE_SIZE, block_size=DEFAULT_BLOCK_SIZE,
+                 compress_cache=None, decompress_cache=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        # only the keys and caches of the codec are used, the work stays in the pool
+        self.codec = CachedCodec(compress_cache, decompress_cache, block_size)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.pool = None
+        # one thread for everything the caches do, so they need no locks
+        self.cache_thread = None
+        self.dispatchers = []
+        self.server = None
+        # writer -> the task serving that connection
+        self.connections = {}
+        self.closing = False
+        # requests and batches handled so far, for a quick look at how well batching works
+        self.requests = 0
+        self.batches = 0
+
+    async def start(self, path=None, host="127.0.0.1", port=0):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        if self.codec.compress_cache is not None or self.codec.decompress_cache is not None:
+            self.cache_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="q2-cache")
+        # one dispatcher per worker, so at most one batch per worker is in flight
+        # and everything else waits in the bounded queue
+        self.dispatchers = [asyncio.ensure_future(self.dispatch()) for _ in range(self.workers)]
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    def cache_entry(self, op, payload):
+        ## (cache, key) for a request, cache is None when that op is not cached
+        if op == OP_COMPRESS and self.codec.compress_cache is not None:
+            return self.codec.compress_cache, self.codec.compress_key(payload)
+        if op == OP_DECOMPRESS and self.codec.decompress_cache is not None:
+            return self.codec.decompress_cache, self.codec.decompress_key(payload)
+        return None, None
+
+    def lookup(self, op, payload):
+        ## on the cache thread: (cache, key, cached result or None), the key goes along
+        ## with a miss so the payload is hashed once
+        cache, key = self.cache_entry(op, payload)
+        return cache, key, cache.get(key) if cache is not None else None
+
+    async def on_cache_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.cache_thread, function, *args)
+
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches, "cache": self.codec.stats()}
+
+    async def current_stats(self):
+        # the cache counters change on the cache thread, read them there
+        if self.cache_thread is None:
+            return self.stats()
+        return await self.on_cache_thread(self.stats)
+
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        ## stops accepting, answers everything still queued or running with an error
+        ## and closes the open connections
+        self.closing = True
+        self.server.close()
+        for task in self.dispatchers:
+            task.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        handlers = list(self.connections.values())
+        for writer in list(self.connections):
+            writer.close()
+        while not self.queue.empty():
+            _, future, _ = self.queue.get_nowait()
+            fail(future)
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await self.server.wait_closed()
+        self.pool.shutdown(cancel_futures=True)
+        if self.cache_thread is not None:
+            self.cache_thread.shutdown()
+
+    async def handle(self, reader, writer):
+        write_lock = asyncio.Lock()
+        pending = set()
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    frame = await read_frame(reader)
+                except ValueError as error:
+                    writer.write(pack_frame(STATUS_ERROR, 0, str(error).encode()))
+                    break
+                if frame is None or self.closing:
+                    break
+                future = asyncio.get_running_loop().create_future()
+                cache, key, cached = None, None, None
+                if frame[0] == OP_STATS:
+                    cached = json.dumps(await self.current_stats()).encode()
+                elif self.cache_thread is not None:
+                    cache, key, cached = await self.on_cache_thread(self.lookup, frame[0], frame[2])
+                if cached is not None:
+                    future.set_result((STATUS_OK, cached))
+                else:
+                    # blocks while the queue is full, which stops us reading this socket
+                    await self.queue.put((frame, future, (cache, key)))
+                    if self.closing:
+                        # got into the queue after close() emptied it, nobody will run it
+                        fail(future)
+                task = asyncio.ensure_future(self.respond(writer, write_lock, frame[1], future))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+    async def respond(self, writer, write_lock, request_id, future):
+        status, payload = await future
+        if writer.is_closing():
+            return
+        try:
+            async with write_lock:
+                writer.write(pack_frame(status, request_id, payload))
+                await writer.drain()
+        except ConnectionError:
+            # the client went away, nobody is waiting for this answer any more
+            pass
+
+    async def next_batch(self):
+        ## waits for one request, then takes whatever else arrives within the batch window
+        batch = [await self.queue.get()]
+        size = len(batch[0][0][2])
+        deadline = asyncio.get_running_loop().time() + BATCH_WAIT_SECONDS
+        getter = None
+        try:
+            while len(batch) < BATCH_MAX_REQUESTS and size < BATCH_MAX_BYTES:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                # a get task of our own rather than wait_for, so a request it already
+                # took off the queue can not get lost when we are cancelled
+                getter = asyncio.ensure_future(self.queue.get())
+                done, _ = await asyncio.wait({getter}, timeout=timeout)
+                if not done:
+                    # still waiting, cancelling it leaves the queue as it was
+                    getter.cancel()
+                    getter = None
+                    break
+                item = getter.result()
+                getter = None
+                batch.append(item)
+                size += len(item[0][2])
+        except asyncio.CancelledError:
+            # close() stopped us while the batch was filling, everything taken so far
+            # is answered with an error instead of being dropped
+            if getter is not None:
+                if getter.done() and not getter.cancelled():
+                    batch.append(getter.result())
+                else:
+                    getter.cancel()
+            for _, future, _ in batch:
+                fail(future)
+            raise
+        return batch
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            requests = [(op, payload) for (op, _, payload), _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.pool, run_batch, requests, self.block_size)
+            except Exception as error:
+                # the worker itself died, every request in the batch gets the error
+                results = [(STATUS_ERROR, f"{type(error).__name__}: {error}".encode())] * len(batch)
+            except asyncio.CancelledError:
+                for _, future, _ in batch:
+                    fail(future)
+                raise
+            self.requests += len(batch)
+            self.batches += 1
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            # answered first, stored after
+            for (_, _, (cache, key)), (status, payload) in zip(batch, results):
+                if cache is not None and status == STATUS_OK:
+                    try:
+                        await self.on_cache_thread(cache.put, key, payload)
+                    except OSError:
+                        # a cache directory that can not be written is not worth failing over
+                        pass
+
+
+class ServiceError(Exception):
+    pass
+
+
+class ServiceClient:
+    ## one connection with any number of requests in flight
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count(1)
+        self.waiting = {}
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect(cls, path=None, host="127.0.0.1", port=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def receive(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+                status, request_id, payload = frame
+                future = self.waiting.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((status, payload))
+        finally:
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("service closed the connection"))
+
+    async def request(self, op, payload):
+        request_id = next(self.ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        self.writer.write(pack_frame(op, request_id, payload))
+        await self.writer.drain()
+        status, payload = await future
+        if status != STATUS_OK:
+            raise ServiceError(payload.decode('utf-8', 'replace'))
+        return payload
+
+    async def compress(self, data):
+        return await self.request(OP_COMPRESS, data)
+
+    async def decompress(self, data):
+        return await self.request(OP_DECOMPRESS, data)
+
+    async def stats(self):
+        return json.loads(await self.request(OP_STATS, b""))
+
+    async def close(self):
+        self.writer.close()
+        self.receiver.cancel()
+        await asyncio.gather(self.receiver, return_exceptions=True)
+
+
+async def serve(args):
+    caches = [None, None]
+    if args.cache_memory or args.cache_dir:
+        directories = [None, None]
+        if args.cache_dir:
+            directories = [os.path.join(args.cache_dir, name) for name in ("compress", "decompress")]
+        caches = [ByteCache(args.cache_memory * 1024 * 1024, directory, args.cache_disk * 1024 * 1024)
+                  for directory in directories]
+    service = CompressionService(args.workers, args.queue_size, args.block_size, *caches)
+    await service.start(args.socket, args.host, args.port)
+    print(f"listening on {service.address()}", flush=True)
+    try:
+        await service.server.serve_forever()
+    finally:
+        await service.close()
+        print(f"stats {json.dumps(service.stats())}", file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BWT/Huffman compression service")
+    parser.add_argument("--socket", help="unix socket path, instead of TCP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7878)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--cache-memory", type=int, default=0, help="MB of results kept in memory, per direction")
+    parser.add_argument("--cache-dir", help="keep results on disk too, under this directory")
+    parser.add_argument("--cache-disk", type=int, default=1024, help="MB of results kept on disk, per direction")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
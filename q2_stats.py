@@ -0,0 +1,114 @@
+import json
+import time
+
+## per-stage counters for the encoder and decoder. nothing is recorded unless a
+## PipelineStats is passed in, the default NO_STATS costs one method call per stage
+##
+##   stats = PipelineStats()
+##   encoder(s, stats=stats)
+##   stats.write_json("encode_stats.json")
+
+STAGE_FIELDS = ("calls", "seconds", "bytes_in", "bytes_out", "items")
+
+
+class Stage:
+    ## what one stage fills in while it runs, added to the totals when it ends
+    __slots__ = ("bytes_in", "bytes_out", "items")
+
+    def __init__(self, bytes_in=0):
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.items = 0
+
+
+class StageTimer:
+    def __init__(self, stats, name, bytes_in):
+        self.stats = stats
+        self.name = name
+        self.stage = Stage(bytes_in)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.stage
+
+    def __exit__(self, *exc):
+        self.stats.record(self.name, time.perf_counter() - self.start, self.stage)
+
+
+class PipelineStats:
+    def __init__(self, callback=None):
+        # name -> {"calls", "seconds", "bytes_in", "bytes_out", "items"}, in first seen order
+        self.stages = {}
+        # called as callback(name, totals for that stage) after every stage
+        self.callback = callback
+
+    def stage(self, name, bytes_in=0):
+        return StageTimer(self, name, bytes_in)
+
+    def record(self, name, seconds, stage):
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = dict.fromkeys(STAGE_FIELDS, 0)
+        totals["calls"] += 1
+        totals["seconds"] += seconds
+        totals["bytes_in"] += stage.bytes_in
+        totals["bytes_out"] += stage.bytes_out
+        totals["items"] += stage.items
+        if self.callback is not None:
+            self.callback(name, totals)
+
+    def merge(self, stages):
+        ## add the totals from another PipelineStats (e.g. one sent back by a worker process)
+        for name, other in stages.items():
+            totals = self.stages.setdefault(name, dict.fromkeys(STAGE_FIELDS, 0))
+            for field in STAGE_FIELDS:
+                totals[field] += other[field]
+
+    def as_dict(self):
+        return {name: dict(totals) for name, totals in self.stages.items()}
+
+    def to_json(self):
+        return json.dumps({"stages": self.as_dict()}, indent=2)
+
+    def write_json(self, filename):
+        with open(filename, 'w') as file:
+            file.write(self.to_json())
+
+
+class NullStage:
+    ## swallows the attribute writes a stage makes
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NullStats:
+    _stage = NullStage()
+
+    def stage(self, name, bytes_in=0):
+        return self._stage
+
+    def merge(self, stages):
+        pass
+
+
+NO_STATS = NullStats()
+
+
+def pop_stats_option(argv):
+    ## pulls "--stats <file>" out of a command line, returns the file name or None
+    if "--stats" not in argv:
+        return None
+    index = argv.index("--stats")
+    if index + 1 >= len(argv):
+        raise SystemExit("--stats needs a file name")
+    filename = argv[index + 1]
+    del argv[index:index + 2]
+    return filename
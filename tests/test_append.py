@@ -0,0 +1,139 @@
+import os
+import random
+
+import pytest
+
+import q2_encoder
+import q2_format
+from q2_codec import Compressor, decompress
+from q2_decoder import decode, decode_range, read_block_file
+from q2_encoder import encoder, append
+from q2_format import HEADER, BLOCK_HEADER, FLAG_INDEX, read_header
+
+
+def random_text(seed, length):
+    rng = random.Random(seed)
+    return ''.join(rng.choice("abcab_XYZ") for _ in range(length))
+
+
+def decoded(tmp_path, archive, workers=1):
+    restored = tmp_path / "out.txt"
+    decode(str(archive), str(restored), workers=workers)
+    return restored.read_text()
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "archive.bin"
+    encoder(random_text(1, 25000), block_size=10000, output_filename=str(path))
+    return path
+
+
+def test_append_roundtrip(tmp_path, archive):
+    a, b, c = random_text(1, 25000), random_text(2, 13000), random_text(3, 7)
+    old = archive.read_bytes()
+    old_end = read_block_file(str(archive))[-1][0]
+
+    assert append(b, str(archive)) == len(a) + len(b)
+    # the old blocks are not touched, the new ones take the archive's block size
+    assert archive.read_bytes()[HEADER.size:old_end] == old[HEADER.size:old_end]
+    assert [length for _, length, _ in read_block_file(str(archive))] == [10000, 10000, 5000, 10000, 3000]
+
+    append(c + "$", str(archive), workers=2)
+    text = a + b + c + "$"
+    with open(archive, 'rb') as file:
+        assert read_header(file)[2] == len(text)
+    for workers in (1, 2):
+        assert decoded(tmp_path, archive, workers) == text
+    assert decode_range(str(archive), 24990, 25020) == text[24990:25020]
+    assert decompress(archive.read_bytes()) == text.encode()
+
+
+def test_append_nothing(archive):
+    size = os.path.getsize(archive)
+    append("", str(archive))
+    assert os.path.getsize(archive) == size
+
+
+def test_append_to_streamed_archive(tmp_path):
+    a, b = random_text(4, 9000), random_text(5, 3000)
+    compressor = Compressor(block_size=4000)
+    archive = tmp_path / "stream.bin"
+    archive.write_bytes(compressor.compress(a.encode()) + compressor.flush())
+    append(b, str(archive))
+    assert decompress(archive.read_bytes()) == (a + b).encode()
+    assert decoded(tmp_path, archive) == a + b
+
+
+def test_append_to_archive_without_index(tmp_path):
+    a, b = random_text(6, 25000), random_text(7, 4000)
+    archive = tmp_path / "noindex.bin"
+    encoder(a, block_size=10000, output_filename=str(archive))
+    # cut the footer and clear its flag, the way block files were written before it
+    raw = bytearray(archive.read_bytes())
+    last = read_block_file(str(archive))[-1][0]
+    _, _, payload_length = BLOCK_HEADER.unpack_from(raw, last)
+    del raw[last + BLOCK_HEADER.size + payload_length:]
+    raw[5] &= ~FLAG_INDEX
+    archive.write_bytes(bytes(raw))
+
+    append(b, str(archive))
+    assert decoded(tmp_path, archive) == a + b
+
+
+def test_append_to_single_stream_is_an_error(tmp_path):
+    archive = tmp_path / "single.bin"
+    encoder("banana$", output_filename=str(archive))
+    with pytest.raises(ValueError):
+        append("abc", str(archive))
+
+
+def streamed_archive(tmp_path):
+    path = tmp_path / "stream.bin"
+    compressor = Compressor(block_size=4000)
+    path.write_bytes(compressor.compress(random_text(1, 25000).encode()) + compressor.flush())
+    return path
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_failed_encode_leaves_the_archive_as_it_was(tmp_path, archive, monkeypatch, streamed):
+    if streamed:
+        archive = streamed_archive(tmp_path)
+    old = archive.read_bytes()
+    encode_blocks = q2_encoder.encode_blocks
+
+    def failing_encode_blocks(*args, **kwargs):
+        # the second block never comes back
+        for i, block in enumerate(encode_blocks(*args, **kwargs)):
+            if i == 1:
+                raise KeyboardInterrupt
+            yield block
+
+    monkeypatch.setattr(q2_encoder, "encode_blocks", failing_encode_blocks)
+    with pytest.raises(KeyboardInterrupt):
+        append(random_text(8, 13000), str(archive))
+    assert archive.read_bytes() == old
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_failed_write_leaves_the_archive_as_it_was(tmp_path, archive, monkeypatch, streamed):
+    if streamed:
+        archive = streamed_archive(tmp_path)
+    old = archive.read_bytes()
+    pack_block = q2_format.pack_block
+    calls = []
+
+    def failing_pack_block(*args):
+        # the first new block is already written over the old footer
+        calls.append(args)
+        if len(calls) == 2:
+            raise OSError("disk full")
+        return pack_block(*args)
+
+    monkeypatch.setattr(q2_format, "pack_block", failing_pack_block)
+    with pytest.raises(OSError):
+        append(random_text(8, 13000), str(archive))
+    assert archive.read_bytes() == old
+    monkeypatch.undo()
+    append(random_text(8, 13000), str(archive))
+    assert decoded(tmp_path, archive) == random_text(1, 25000) + random_text(8, 13000)
@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+from q2_codec import Compressor, Decompressor, compress, decompress
+from q2_decoder import decode, decode_range
+from q2_encoder import encoder
+
+
+def random_bytes(seed, length, alphabet=b"abcab~xyz"):
+    rng = random.Random(seed)
+    return bytes(rng.choice(alphabet) for _ in range(length))
+
+
+def feed(codec_method, data, rng, max_chunk):
+    ## data in random sized chunks through compress() or decompress()
+    out = []
+    i = 0
+    while i < len(data):
+        size = rng.randint(1, max_chunk)
+        out.append(codec_method(data[i:i + size]))
+        i += size
+    return b''.join(out)
+
+
+LENGTHS = [0, 1, 5, 99, 100, 101, 1000, 2345]
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+@pytest.mark.parametrize("block_size", [7, 100, 1000])
+def test_compress_roundtrip(length, block_size):
+    data = random_bytes(length, length)
+    assert decompress(compress(data, block_size=block_size)) == data
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+@pytest.mark.parametrize("block_size", [7, 100, 1000])
+def test_compress_is_the_block_file_the_encoder_writes(tmp_path, length, block_size):
+    text = random_bytes(length, length).decode('latin-1')
+    if length % 2:
+        text += "$"
+    compressed = tmp_path / "out.bin"
+    encoder(text, block_size=block_size, workers=1, output_filename=str(compressed))
+    assert compress(text.encode('latin-1'), block_size=block_size) == compressed.read_bytes()
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+@pytest.mark.parametrize("known_length", [True, False])
+def test_streaming_roundtrip(tmp_path, length, known_length):
+    rng = random.Random(length)
+    data = random_bytes(length, length)
+    compressor = Compressor(block_size=100, length=len(data) if known_length else None)
+    compressed = feed(compressor.compress, data, rng, 50) + compressor.flush()
+    if known_length:
+        assert compressed == compress(data, block_size=100)
+
+    decompressor = Decompressor()
+    restored = feed(decompressor.decompress, compressed, rng, 40) + decompressor.flush()
+    assert restored == data
+    assert decompressor.eof
+
+    # a streamed file is a normal block file for the decoder and for random access
+    archive = tmp_path / "stream.bin"
+    archive.write_bytes(compressed)
+    decode(str(archive), str(tmp_path / "out.txt"))
+    assert (tmp_path / "out.txt").read_bytes() == data
+    assert decode_range(str(archive), 3, 250) == data[3:250].decode('latin-1')
+
+
+def test_streaming_binary_data():
+    data = bytes(range(256)) * 20
+    compressor = Compressor(block_size=300)
+    compressed = feed(compressor.compress, data, random.Random(1), 77) + compressor.flush()
+    assert decompress(compressed) == data
+
+
+def test_wrong_length_is_an_error():
+    compressor = Compressor(block_size=100, length=10)
+    compressor.compress(b"abc")
+    with pytest.raises(ValueError):
+        compressor.flush()
+
+
+def test_compress_after_flush_is_an_error():
+    compressor = Compressor()
+    compressor.flush()
+    with pytest.raises(ValueError):
+        compressor.compress(b"abc")
+
+
+def test_truncated_data_is_an_error():
+    compressed = compress(random_bytes(1, 1000), block_size=100)
+    decompressor = Decompressor()
+    decompressor.decompress(compressed[:150])
+    with pytest.raises(ValueError):
+        decompressor.flush()
+
+
+def test_single_stream_container(tmp_path):
+    compressed = tmp_path / "out.bin"
+    encoder("hello$", output_filename=str(compressed))
+    assert decompress(compressed.read_bytes()) == b"hello$"
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from q1 import build_suffix_array
+from q2_decoder import decode
+from q2_encoder import encoder
+from q2_external import MappedText, encode_file_external, iter_external_suffix_array
+
+
+def random_text(seed, length, alphabet="acgt"):
+    rng = random.Random(seed)
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+CASES = ["$", "a", "ab$", "aaaa", "abab" * 50 + "$", "a" * 300, random_text(1, 3000),
+         random_text(2, 2000, "abcab_XYZ~%|")]
+
+
+@pytest.mark.parametrize("s", CASES)
+@pytest.mark.parametrize("memory_budget", [600, 5000, 10 ** 7])
+def test_external_suffix_array(tmp_path, s, memory_budget):
+    # a small budget means many runs and merge passes
+    text_file = tmp_path / "in.txt"
+    text_file.write_text(s + "\n")
+    full = s if s.endswith("$") else s + "$"
+    with MappedText(str(text_file)) as text:
+        assert list(iter_external_suffix_array(text, memory_budget, str(tmp_path))) == build_suffix_array(full)
+
+
+@pytest.mark.parametrize("s", CASES)
+def test_external_writes_the_single_stream_the_encoder_does(tmp_path, s):
+    text_file = tmp_path / "in.txt"
+    text_file.write_text(s + "\n")
+    full = s if s.endswith("$") else s + "$"
+    encode_file_external(str(text_file), str(tmp_path / "ext.bin"), 2000, str(tmp_path))
+    encoder(full, output_filename=str(tmp_path / "ref.bin"))
+    assert (tmp_path / "ext.bin").read_bytes() == (tmp_path / "ref.bin").read_bytes()
+    decode(str(tmp_path / "ext.bin"), str(tmp_path / "out.txt"))
+    assert (tmp_path / "out.txt").read_text() == full
+
+
+def test_characters_outside_the_alphabet(tmp_path):
+    text_file = tmp_path / "in.txt"
+    text_file.write_text("ab$cd")
+    with pytest.raises(ValueError):
+        MappedText(str(text_file))
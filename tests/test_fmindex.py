@@ -0,0 +1,63 @@
+import os
+import random
+
+import pytest
+
+from q2_encoder import encoder
+from q2_fmindex import build_fm_index, open_fm_index, index_filename_for
+
+
+def random_text(seed, length, alphabet="acgt_ACGT"):
+    rng = random.Random(seed)
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def naive_locate(s, pattern, block_size):
+    positions = [i for i in range(len(s) - len(pattern) + 1) if s.startswith(pattern, i)]
+    if block_size is not None:
+        # every block is its own BWT, matches across a block boundary are not found
+        positions = [i for i in positions if i // block_size == (i + len(pattern) - 1) // block_size]
+    return positions
+
+
+@pytest.mark.parametrize("block_size", [None, 50, 997])
+@pytest.mark.parametrize("interval", [64, 256, 32768])
+def test_count_and_locate(tmp_path, block_size, interval):
+    s = random_text(1, 3000)
+    if block_size is None:
+        s += "$"
+    archive = str(tmp_path / "archive.bin")
+    encoder(s, block_size=block_size, workers=1, output_filename=archive)
+    build_fm_index(archive, interval=interval, sample_rate=8)
+    rng = random.Random(2)
+    with open_fm_index(archive) as index:
+        for _ in range(60):
+            start = rng.randrange(len(s))
+            pattern = s[start:start + rng.randint(1, 6)]
+            expected = naive_locate(s, pattern, block_size)
+            assert index.locate(pattern) == expected
+            assert index.count(pattern) == len(expected)
+        assert index.count("ZZZQ") == 0
+        assert index.locate("") == []
+
+
+@pytest.mark.parametrize("interval", [0, 100, 65536])
+def test_bad_interval(tmp_path, interval):
+    archive = str(tmp_path / "archive.bin")
+    encoder("banana$", output_filename=archive)
+    with pytest.raises(ValueError):
+        build_fm_index(archive, interval=interval)
+
+
+def test_stale_index_is_rebuilt(tmp_path):
+    archive = str(tmp_path / "archive.bin")
+    encoder(random_text(3, 500) + "$", output_filename=archive)
+    with open_fm_index(archive) as index:
+        assert index.matches(archive)
+    encoder(random_text(4, 700) + "$", output_filename=archive)
+    stat = os.stat(archive)
+    os.utime(archive, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with open_fm_index(archive) as index:
+        assert index.matches(archive)
+        assert index.count("$") == 1
+    assert os.path.exists(index_filename_for(archive))
@@ -0,0 +1,77 @@
+import heapq
+import random
+from collections import Counter
+
+import pytest
+
+from q2_huffman import package_merge, canonical_codes, MAX_CODE_LENGTH
+
+
+def huffman_cost(frequencies):
+    ## total bits of an unlimited huffman code, merging the two cheapest every time
+    heap = list(frequencies.values())
+    heapq.heapify(heap)
+    cost = 0
+    while len(heap) > 1:
+        merged = heapq.heappop(heap) + heapq.heappop(heap)
+        cost += merged
+        heapq.heappush(heap, merged)
+    return cost
+
+
+def kraft_sum(lengths):
+    return sum(2.0 ** -length for length in lengths.values())
+
+
+def random_frequencies(seed, symbols):
+    rng = random.Random(seed)
+    return {chr(36 + i): rng.randint(1, 1000) for i in range(symbols)}
+
+
+def fibonacci_frequencies(symbols):
+    # the worst case for code length, unlimited huffman gives the rarest one symbols - 1 bits
+    a, b = 1, 1
+    frequencies = {}
+    for i in range(symbols):
+        frequencies[chr(36 + i)] = a
+        a, b = b, a + b
+    return frequencies
+
+
+@pytest.mark.parametrize("frequencies", [random_frequencies(seed, symbols)
+                                         for seed, symbols in enumerate([2, 3, 5, 17, 60, 91])])
+def test_package_merge_is_optimal_when_the_limit_does_not_bind(frequencies):
+    lengths = package_merge(frequencies)
+    assert set(lengths) == set(frequencies)
+    assert kraft_sum(lengths) == 1
+    assert sum(frequencies[symbol] * lengths[symbol] for symbol in frequencies) == huffman_cost(frequencies)
+
+
+@pytest.mark.parametrize("max_length", [7, 10, MAX_CODE_LENGTH])
+def test_package_merge_limits_the_length(max_length):
+    frequencies = fibonacci_frequencies(40)
+    lengths = package_merge(frequencies, max_length)
+    assert max(lengths.values()) == max_length
+    assert kraft_sum(lengths) <= 1
+    # rarer symbols never get shorter codes
+    ordered = sorted(frequencies, key=lambda symbol: frequencies[symbol])
+    assert [lengths[symbol] for symbol in ordered] == sorted((lengths[symbol] for symbol in ordered), reverse=True)
+
+
+def test_package_merge_small_alphabets():
+    assert package_merge({}) == {}
+    assert package_merge({"a": 5}) == {"a": 1}
+    assert package_merge({"a": 5, "b": 1}) == {"a": 1, "b": 1}
+    with pytest.raises(ValueError):
+        package_merge({chr(36 + i): 1 for i in range(9)}, max_length=3)
+
+
+def test_canonical_codes_are_prefix_free():
+    lengths = package_merge(Counter("abracadabra_the_quick_brown_fox$"))
+    codes = canonical_codes(lengths)
+    assert {symbol: len(code) for symbol, code in codes.items()} == lengths
+    ordered = sorted(codes.values())
+    for code, following in zip(ordered, ordered[1:]):
+        assert not following.startswith(code)
+    # the lengths alone give back the same codes, which is all the header carries
+    assert canonical_codes(dict(lengths)) == codes
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from q1 import RankIndex, build_rank_index, answer_rank_queries, main
+
+
+def naive_ranks(s):
+    suffix_array = sorted(range(len(s)), key=lambda i: s[i:])
+    return {start: rank + 1 for rank, start in enumerate(suffix_array)}
+
+
+@pytest.fixture
+def text_file(tmp_path):
+    rng = random.Random(1)
+    path = tmp_path / "text.txt"
+    path.write_text(''.join(rng.choice("acgt") for _ in range(500)) + "$")
+    return path
+
+
+def test_rank_index(tmp_path, text_file):
+    s = text_file.read_text()
+    index_file = str(tmp_path / "text.saix")
+    assert build_rank_index(str(text_file), index_file) == len(s)
+    ranks = naive_ranks(s)
+    positions = tmp_path / "positions.txt"
+    positions.write_text("1 2 3\n250\n501\n")
+    output = tmp_path / "output.txt"
+    assert answer_rank_queries(index_file, str(positions), str(output)) == 5
+    assert output.read_text().split() == [str(ranks[p - 1]) for p in (1, 2, 3, 250, 501)]
+    with RankIndex(index_file) as index:
+        assert [index.rank(p) for p in range(1, len(s) + 1)] == [ranks[i] for i in range(len(s))]
+
+
+@pytest.mark.parametrize("position", [0, -1, 502])
+def test_positions_outside_the_text(tmp_path, monkeypatch, text_file, position):
+    monkeypatch.chdir(tmp_path)
+    index_file = str(tmp_path / "text.saix")
+    build_rank_index(str(text_file), index_file)
+    positions = tmp_path / "positions.txt"
+    positions.write_text(f"1\n{position}\n")
+    with RankIndex(index_file) as index, pytest.raises(ValueError):
+        index.rank(position)
+    with pytest.raises(ValueError):
+        answer_rank_queries(index_file, str(positions), str(tmp_path / "output.txt"))
+    with pytest.raises(ValueError):
+        main(str(text_file), str(positions))
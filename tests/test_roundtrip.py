@@ -0,0 +1,129 @@
+import random
+
+import pytest
+
+from q2_decoder import decode, decode_range, read_block_file
+from q2_encoder import encoder, encode_stream
+from q2_format import read_header
+from q2_models import train_model, save_model
+
+
+def random_text(seed, length, alphabet="abcab_XYZ~%"):
+    rng = random.Random(seed)
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def skewed_text(seed, length):
+    # halving weights give the long codewords that get length limited
+    rng = random.Random(seed)
+    alphabet = [chr(code) for code in range(37, 127)]
+    weights = [2.0 ** -(i % 30) for i in range(len(alphabet))]
+    return ''.join(rng.choices(alphabet, weights, k=length))
+
+
+def read_text(filename):
+    with open(filename, 'r', encoding='latin-1', newline='') as file:
+        return file.read()
+
+
+def roundtrip(tmp_path, s, workers=1, inverse="full", **options):
+    # workers is used on both sides, the rest goes to the encoder
+    compressed = tmp_path / "out.bin"
+    restored = tmp_path / "out.txt"
+    encoder(s, workers=workers, output_filename=str(compressed), **options)
+    decode(str(compressed), str(restored), workers=workers, inverse=inverse)
+    return read_text(restored)
+
+
+SINGLE_STREAM_CASES = ["$", "a$", "a" * 500 + "$", "banana$", "mississippi$",
+                       random_text(1, 5000) + "$", skewed_text(2, 3000) + "$"]
+
+
+@pytest.mark.parametrize("s", SINGLE_STREAM_CASES)
+@pytest.mark.parametrize("canonical", [True, False])
+def test_single_stream(tmp_path, s, canonical):
+    assert roundtrip(tmp_path, s, canonical=canonical) == s
+
+
+@pytest.mark.parametrize("engine", ["sais", "ukkonen"])
+def test_single_stream_engines_write_the_same_file(tmp_path, engine):
+    s = random_text(3, 3000) + "$"
+    encoder(s, "sais", output_filename=str(tmp_path / "sais.bin"))
+    encoder(s, engine, output_filename=str(tmp_path / "other.bin"))
+    assert (tmp_path / "sais.bin").read_bytes() == (tmp_path / "other.bin").read_bytes()
+
+
+@pytest.mark.parametrize("inverse", ["full", "checkpointed", "checkpointed:64", "checkpointed:32768"])
+def test_single_stream_inverse_engines(tmp_path, inverse):
+    s = random_text(4, 20000) + "$"
+    assert roundtrip(tmp_path, s, inverse=inverse) == s
+
+
+@pytest.mark.parametrize("s", SINGLE_STREAM_CASES)
+def test_legacy_ascii_file(tmp_path, s):
+    # what the encoder wrote before the container: the bitstream as '0'/'1' text,
+    # with every codeword in the header
+    legacy = tmp_path / "legacy.txt"
+    legacy.write_text(encode_stream(s, canonical=False).to01())
+    restored = tmp_path / "out.txt"
+    decode(str(legacy), str(restored))
+    assert read_text(restored) == s
+
+
+@pytest.mark.parametrize("length", [0, 1, 999, 1000, 1001, 4567])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_block_mode(tmp_path, length, workers):
+    s = random_text(length, length)
+    assert roundtrip(tmp_path, s, workers, block_size=1000) == s
+
+
+@pytest.mark.parametrize("canonical", [True, False])
+def test_block_mode_with_sentinel_and_long_codes(tmp_path, canonical):
+    s = skewed_text(5, 2500) + "$"
+    assert roundtrip(tmp_path, s, block_size=1000, canonical=canonical) == s
+
+
+def test_block_mode_checkpointed_inverse(tmp_path):
+    s = random_text(6, 5000)
+    assert roundtrip(tmp_path, s, inverse="checkpointed:128", block_size=2000) == s
+
+
+def test_block_mode_stores_bytes_outside_the_alphabet(tmp_path):
+    s = "line one\nline two\t\x00\xff" * 50
+    assert roundtrip(tmp_path, s, block_size=300) == s
+
+
+def test_block_mode_header_and_index(tmp_path):
+    s = random_text(7, 2500)
+    compressed = str(tmp_path / "out.bin")
+    encoder(s, block_size=1000, output_filename=compressed)
+    with open(compressed, 'rb') as file:
+        assert read_header(file)[2] == len(s)
+    entries = read_block_file(compressed)
+    assert [(length, start) for _, length, start in entries] == [(1000, 0), (1000, 1000), (500, 2000)]
+
+
+def test_decode_range(tmp_path):
+    s = random_text(8, 4567)
+    compressed = str(tmp_path / "out.bin")
+    encoder(s, block_size=1000, output_filename=compressed)
+    for start, stop in [(0, 1), (0, 4567), (990, 1010), (1000, 2000), (3999, 4567), (4000, 9999), (12, 12)]:
+        assert decode_range(compressed, start, stop) == s[start:stop]
+    assert decode_range(compressed, 1990, 2010, inverse="checkpointed:64") == s[1990:2010]
+
+
+def test_decode_range_needs_blocks(tmp_path):
+    compressed = str(tmp_path / "out.bin")
+    encoder("banana$", output_filename=compressed)
+    with pytest.raises(ValueError):
+        decode_range(compressed, 0, 3)
+
+
+@pytest.mark.parametrize("block_size", [None, 1000])
+def test_pretrained_model(tmp_path, monkeypatch, block_size):
+    # models are looked up under ./models unless told otherwise
+    monkeypatch.chdir(tmp_path)
+    model = train_model([random_text(9, 2000)])
+    save_model(model)
+    s = random_text(10, 2500) + "$"
+    assert roundtrip(tmp_path, s, block_size=block_size, model=model.id) == s
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from q2_cache import ByteCache
+from q2_codec import compress
+from q2_service import CompressionService, ServiceClient, ServiceError
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 60))
+
+
+async def with_service(tmp_path, body, **options):
+    service = CompressionService(workers=1, queue_size=2, block_size=1000, **options)
+    await service.start(path=str(tmp_path / "q2.sock"))
+    client = await ServiceClient.connect(str(tmp_path / "q2.sock"))
+    try:
+        return await body(client, service)
+    finally:
+        await client.close()
+        await service.close()
+
+
+def test_roundtrip(tmp_path):
+    payloads = [b"hello_world" * i for i in range(1, 20)] + [bytes(range(256))]
+
+    async def body(client, service):
+        compressed = await asyncio.gather(*[client.compress(data) for data in payloads])
+        assert compressed == [compress(data, block_size=1000) for data in payloads]
+        assert await asyncio.gather(*[client.decompress(data) for data in compressed]) == payloads
+        assert service.requests == 2 * len(payloads)
+
+    run(with_service(tmp_path, body))
+
+
+def test_bad_data_is_an_error_for_that_request_only(tmp_path):
+    async def body(client, service):
+        with pytest.raises(ServiceError):
+            await client.decompress(b"junk")
+        assert await client.decompress(await client.compress(b"still here")) == b"still here"
+
+    run(with_service(tmp_path, body))
+
+
+def test_cache_and_stats(tmp_path):
+    async def body(client, service):
+        first = await client.compress(b"abc" * 1000)
+        second = await client.compress(b"abc" * 1000)
+        assert first == second
+        assert await client.decompress(first) == b"abc" * 1000
+        return await client.stats()
+
+    stats = run(with_service(tmp_path, body, compress_cache=ByteCache(directory=str(tmp_path / "cache"))))
+    # the hit never reaches the pool
+    assert stats["requests"] == 2
+    assert stats["cache"]["compress"]["memory_hits"] == 1
+    assert stats["cache"]["compress"]["misses"] == 1
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from q1 import build_suffix_array, stream_suffix_array, inverse_suffix_array
+from q2_encoder import compute_bwt
+
+
+def naive_suffix_array(s):
+    return sorted(range(len(s)), key=lambda i: s[i:])
+
+
+def random_strings(seed, alphabet, count, max_length):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, max_length))) for _ in range(count)]
+
+
+# small alphabets give the long repeats SA-IS recurses on, the wide one every code in the codec alphabet
+CASES = (random_strings(1, "ab", 300, 40) + random_strings(2, "abc", 200, 200)
+         + random_strings(3, ''.join(chr(c) for c in range(37, 127)), 50, 500)
+         + ["a", "aaaaaaaa", "abababab", "mississippi", "banana", "ba" * 100 + "a" * 50])
+
+
+@pytest.mark.parametrize("s", CASES)
+def test_sais_matches_naive_sort(s):
+    assert build_suffix_array(s, "sais") == naive_suffix_array(s)
+
+
+@pytest.mark.parametrize("s", CASES[::5])
+def test_ukkonen_matches_naive_sort(s):
+    # the tree needs the unique terminator to end every suffix in a leaf
+    s += "$"
+    assert list(build_suffix_array(s, "ukkonen")) == naive_suffix_array(s)
+
+
+@pytest.mark.parametrize("engine", ["sais", "ukkonen"])
+def test_stream_suffix_array_is_the_same_order(engine):
+    s = "abracadabra_abracadabra$"
+    assert list(stream_suffix_array(s, engine)) == naive_suffix_array(s)
+
+
+def test_inverse_suffix_array():
+    s = "mississippi$"
+    suffix_array = naive_suffix_array(s)
+    inverse = inverse_suffix_array(suffix_array)
+    assert [suffix_array[rank] for rank in inverse] == list(range(len(s)))
+
+
+def test_bwt():
+    assert compute_bwt("banana$") == "annb$aa"
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        build_suffix_array("abc$", "qsort")